@@ -1,38 +1,18 @@
 '''Plot and analyze data extracted from thermal images of grains.'''
 
 import matplotlib.pyplot as plt
-import matplotlib.patches as mpatches
 
-from img_processing import default_img_set, full_prepare
-from blob_series_tracker import count_blobs_with_all_methods
-
-
-def plot_blob_stat(samples_set, lebels_set, colors):
-    '''Plot blob count versus minutes.'''
-    plt.figure()
-    for sample_series, sample_label_index in zip(samples_set, lebels_set):
-        plt.plot(
-            [0, 1, 2, 3, 4],
-            sample_series,
-            c=colors[sample_label_index],
-            linewidth=1.2)
-
-
-def patch_plot_legend(colors, labels):
-    '''Make given plots share their legend entry.'''
-    legend = [
-        mpatches.Patch(color=color, label=label)
-        for color, label in zip(colors, labels)
-    ]
-    plt.legend(handles=legend)
+from blob_finder import BlobCache
+from img_processing import default_img_set_paths
+from blob_series_tracker import count_blobs_with_all_methods_parallel
+from plotting import patch_plot_legend, plot_blob_stat
 
 
 def main():
     '''Plot number of detected blobs using three ways of counting.'''
-    X, y = default_img_set()
-    X = [[full_prepare(img) for img in same_sample] for same_sample in X]
-
-    Xa, Xr, Xp = count_blobs_with_all_methods(X)
+    paths, y = default_img_set_paths()
+    Xa, Xr, Xp = count_blobs_with_all_methods_parallel(paths,
+                                                       cache=BlobCache())
 
     colors = ('r', 'g', 'b', 'y')
     labels = ('E5R', 'E6R', 'E11R', 'E16R')
@@ -1,29 +1,298 @@
 '''Find blobs in thermal images of grains.'''
 
-from math import sqrt
+from functools import lru_cache
+from math import pi, sqrt
+import os
+import tempfile
 
-import matplotlib.pyplot as plt
-from skimage.color import rgb2gray
-from skimage.feature import blob_dog
-from skimage.io import imread
-from skimage.util import invert
+import numpy as np
 
-from img_processing import crop_ui, get_temperature_bounds, show_with_hist
+from img_processing import content_hash, crop_ui, get_temperature_bounds
+from instrumentation import count, timer
 
 
-def find_blobs(img):
+@lru_cache(maxsize=None)
+def _skimage_version_str():
+    '''Get full version of installed skimage.'''
+    import skimage
+    return skimage.__version__
+
+
+def _skimage_version():
+    '''Get major and minor version of installed skimage.'''
+    return tuple(int(v) for v in _skimage_version_str().split('.')[:2])
+
+
+class BlobCache:
+    '''
+    On-disk cache of detected blobs keyed by content of prepared image
+    and detector parameters. Least recently used entries are evicted when
+    total size of cache exceeds max_bytes, down to low_water fraction of it,
+    so that directory is scanned only once in many writes. Size is tracked
+    per process, with parallel writers cache may exceed max_bytes until
+    next scan.
+    '''
+
+    # Part of every key, increase when format of stored blobs changes
+    FORMAT_VERSION = 1
+
+    def __init__(self, cache_dir='.blob_cache', max_bytes=64 * 2**20,
+                 low_water=0.8):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.low_water = low_water
+        # Total size of entries, known after first scan of directory
+        self._size = None
+
+    @classmethod
+    def key(cls, img, **params):
+        '''
+        Get hash of image content, shape, detector parameters and format
+        of cache entries.
+        '''
+        return content_hash(img, cache_format=cls.FORMAT_VERSION, **params)
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + '.npy')
+
+    def get(self, key):
+        '''Get cached blobs for key or None if they are not present.'''
+        path = self._path(key)
+        try:
+            blobs = np.load(path)
+        except (OSError, ValueError):
+            return None
+        # Mark entry as recently used, entry may be already evicted
+        # by other process
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return blobs
+
+    def put(self, key, blobs):
+        '''Store blobs under key and evict old entries if needed.'''
+        os.makedirs(self.cache_dir, exist_ok=True)
+        # Write to temporary file first, so that concurrent readers never
+        # see partially written entry
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as tmp_file:
+                np.save(tmp_file, blobs)
+                size = tmp_file.tell()
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+        path = self._path(key)
+        try:
+            replaced_size = os.stat(path).st_size
+        except OSError:
+            replaced_size = 0
+        os.replace(tmp_path, path)
+
+        if self._size is None:
+            self.evict()
+        else:
+            self._size += size - replaced_size
+            if self._size > self.max_bytes:
+                self.evict(self.low_water * self.max_bytes)
+
+    def evict(self, max_bytes=None):
+        '''
+        Remove least recently used entries until cache fits max_bytes,
+        by default the max_bytes of cache.
+        '''
+        if max_bytes is None:
+            max_bytes = self.max_bytes
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.endswith('.npy'):
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total_size <= max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total_size -= size
+        self._size = total_size
+
+    def clear(self):
+        '''Remove all entries from cache.'''
+        if os.path.isdir(self.cache_dir):
+            for entry in os.scandir(self.cache_dir):
+                if entry.name.endswith('.npy'):
+                    try:
+                        os.remove(entry.path)
+                    except FileNotFoundError:
+                        # Already evicted by other process
+                        pass
+        self._size = 0
+
+
+def skimage_dog_detector(img, max_sigma, threshold):
+    '''Detect blobs with Difference of Gaussian implemented in skimage.'''
+    from skimage.feature import blob_dog
+
+    return blob_dog(img, max_sigma=max_sigma, threshold=threshold)
+
+
+def fast_dog_detector(img, max_sigma, threshold, min_sigma=1,
+                      sigma_ratio=1.6, overlap=0.5):
+    '''
+    Detect blobs with Difference of Gaussian giving the same blobs in the
+    same order as skimage blob_dog, but with peaks searched only among pixels
+    above threshold and overlap of blobs computed with array operations.
+    '''
+    from scipy import ndimage as ndi
+    from skimage.util import img_as_float
+
+    # Compute in the same float type and with the same sigmas as skimage
+    img = img_as_float(img)
+    dtype = np.promote_types(img.dtype, np.float32)
+    img = img.astype(dtype, copy=False)
+    min_sigmas = np.full(img.ndim, min_sigma, dtype=dtype)
+    max_sigmas = np.full(img.ndim, max_sigma, dtype=dtype)
+    k = int(np.mean(np.log(max_sigmas / min_sigmas) / np.log(sigma_ratio) + 1))
+    sigmas = np.array([min_sigmas[0] * (sigma_ratio ** i)
+                       for i in range(k + 1)], dtype=dtype)
+
+    # Stack differences of successive Gaussian blurs along first axis
+    dog_cube = np.empty((k,) + img.shape, dtype=dtype)
+    gaussian_previous = ndi.gaussian_filter(img, sigmas[0], mode='reflect')
+    for i, sigma in enumerate(sigmas[1:]):
+        gaussian_current = ndi.gaussian_filter(img, sigma, mode='reflect')
+        np.subtract(gaussian_previous, gaussian_current, out=dog_cube[i])
+        gaussian_previous = gaussian_current
+    # skimage changed DoG scale normalization in 0.19, follow installed one
+    if _skimage_version() < (0, 19):
+        dog_cube *= sigmas[:-1, np.newaxis, np.newaxis]
+    else:
+        dog_cube *= 1 / (sigma_ratio - 1)
+    # Constant cube has no peaks
+    if dog_cube.min() == dog_cube.max():
+        return np.empty((0, 3))
+
+    # Candidate is a peak if it is maximum of its 3x3x3 neighbourhood
+    candidates = np.nonzero(dog_cube > threshold)
+    padded_cube = np.pad(dog_cube, 1, mode='edge')
+    neighbourhood = [padded_cube[candidates[0] + ds,
+                                 candidates[1] + dr,
+                                 candidates[2] + dc]
+                     for ds in range(3) for dr in range(3) for dc in range(3)]
+    values = dog_cube[candidates]
+    is_peak = values >= np.max(neighbourhood, axis=0)
+    scale, row, col = (idx[is_peak] for idx in candidates)
+    if len(row) == 0:
+        return np.empty((0, 3))
+
+    # Order peaks from the strongest, ties by position, as skimage does
+    order = np.lexsort((scale, col, row, -values[is_peak]))
+    blobs = np.column_stack((row[order].astype(dtype),
+                             col[order].astype(dtype),
+                             sigmas[scale[order]]))
+    return _prune_blobs(blobs, overlap)
+
+
+def _prune_blobs(blobs, overlap):
+    '''
+    Remove smaller of blobs overlapping by more than given fraction. Overlap
+    of all close pairs is computed at once, then pairs are resolved one by
+    one in the same order as in skimage, where blob already removed does not
+    remove any other blob.
+    '''
+    from scipy.spatial import cKDTree
+
+    if len(blobs) < 2:
+        return blobs
+    distance = 2 * blobs[:, 2].max() * sqrt(2)
+    pairs = cKDTree(blobs[:, :2]).query_pairs(distance)
+    if not pairs:
+        return blobs
+    # Keep iteration order of set of pairs, which skimage follows
+    pairs = np.array(list(pairs))
+
+    # Fraction of area of smaller blob overlapped, in units of larger sigma
+    sigma1, sigma2 = blobs[pairs[:, 0], 2], blobs[pairs[:, 1], 2]
+    first_larger = sigma1 > sigma2
+    sigma_max = np.where(first_larger, sigma1, sigma2)
+    r1 = np.where(first_larger, 1, sigma1 / sigma2)
+    r2 = np.where(first_larger, sigma2 / sigma1, 1)
+    scale = (sigma_max * sqrt(2))[:, np.newaxis]
+    delta = blobs[pairs[:, 1], :2] / scale - blobs[pairs[:, 0], :2] / scale
+    d = np.sqrt(np.sum(delta ** 2, axis=1))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        acos1 = np.arccos(np.clip((d**2 + r1**2 - r2**2) / (2 * d * r1),
+                                  -1, 1))
+        acos2 = np.arccos(np.clip((d**2 + r2**2 - r1**2) / (2 * d * r2),
+                                  -1, 1))
+        lens = np.sqrt(np.abs((-d + r2 + r1) * (d - r2 + r1) *
+                              (d + r2 - r1) * (d + r2 + r1)))
+        area = r1**2 * acos1 + r2**2 * acos2 - 0.5 * lens
+        blob_overlap = area / (pi * np.minimum(r1, r2)**2)
+    blob_overlap[d > r1 + r2] = 0
+    blob_overlap[d <= np.abs(r1 - r2)] = 1
+
+    is_overlapping = blob_overlap > overlap
+    smaller = np.where(first_larger, pairs[:, 1], pairs[:, 0])[is_overlapping]
+    larger = np.where(first_larger, pairs[:, 0], pairs[:, 1])[is_overlapping]
+    is_pruned = np.zeros(len(blobs), dtype=bool)
+    for small, large in zip(smaller.tolist(), larger.tolist()):
+        if not is_pruned[large]:
+            is_pruned[small] = True
+    return blobs[~is_pruned]
+
+
+DETECTORS = {
+    'skimage_dog': skimage_dog_detector,
+    'fast_dog': fast_dog_detector,
+}
+
+
+def find_blobs(img, max_sigma=2, threshold=0.1, cache=None,
+               detector='skimage_dog'):
     '''
     Find blobs in given image and get list of their positions and radiuses.
+    Detector is chosen by name from DETECTORS. If cache is given, detection
+    is skipped for images already seen with the same version of skimage.
     '''
+    if cache is not None:
+        # Detectors follow installed skimage, which changed DoG over time
+        key = cache.key(img, max_sigma=max_sigma, threshold=threshold,
+                        detector=detector, skimage=_skimage_version_str())
+        blobs = cache.get(key)
+        if blobs is not None:
+            count('blob_cache_hits')
+            return blobs
+
     # Detect blobs with Difference of Gaussian
-    blobs = blob_dog(img, max_sigma=2, threshold=0.1)
+    with timer('blob_detection ' + detector):
+        blobs = DETECTORS[detector](img, max_sigma, threshold)
+    count('frames_detected')
+    count('blobs_detected', len(blobs))
     # Get blobs radiuses from each kernel sigma
     blobs[:, 2] = blobs[:, 2] * sqrt(2)
+
+    if cache is not None:
+        cache.put(key, blobs)
     return blobs
 
 
 def main():
     '''Demo blob finding in grain image.'''
+    import matplotlib.pyplot as plt
+    from skimage.color import rgb2gray
+    from skimage.io import imread
+    from skimage.util import invert
+
+    from plotting import plot_blobs, show_with_hist
+
     # Load and show
     img = imread('img/104_E5R_0.jpg')
     img = rgb2gray(img)
@@ -47,10 +316,7 @@ def main():
     _, ax = plt.subplots(1)
     plt.title("blobs detection with DoH")
     plt.imshow(img_crop, cmap=plt.get_cmap('gray'))
-    for blob in blobs:
-        y, x, r = blob
-        c = plt.Circle((x, y), r, color='r', linewidth=0.75, fill=False)
-        ax.add_patch(c)
+    plot_blobs(ax, blobs)
     ax.set_axis_off()
     print(len(blobs))
 
@@ -1,20 +1,15 @@
 '''Track and count number of blobs in thermal images of grains.'''
 
-import matplotlib.pyplot as plt
-import matplotlib.patches as mpatches
-from skimage.color import rgb2gray
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from itertools import chain
 
-from img_processing import crop_ui, full_prepare, load_img_series
-from blob_finder import find_blobs
+import numpy as np
 
-
-def patch_plot_legend_outside(colors, labels):
-    '''
-    Make given plots share their legend entry and place legend upper right.
-    '''
-    legend = [mpatches.Patch(color=color, label=label)
-              for color, label in zip(colors, labels)]
-    plt.legend(handles=legend, loc='upper right', bbox_to_anchor=(1, 1))
+from img_processing import (crop_ui, fast_prepare, full_prepare,
+                            iter_img_series, load_img_series)
+from blob_finder import BlobCache, find_blobs
+from instrumentation import timed
 
 
 def inside_circle(x, y, a, b, r):
@@ -25,35 +20,54 @@ def inside_circle(x, y, a, b, r):
     return (x - a) * (x - a) + (y - b) * (y - b) < r * r
 
 
+@timed()
 def find_remaining_blobs(new_blobs, old_blobs):
     '''
-    Return list of blobs present in both lists, where blob is considered same
+    Return array of blobs present in both arrays, where blob is considered same
     if is in proximity of 2 times it's radius.
     '''
-    remaining = []
-    for new_blob in new_blobs:
-        yn, xn, _ = new_blob
-        for old_blob in old_blobs:
-            yo, xo, ro = old_blob
-            if inside_circle(xn, yn, xo, yo, 2 * ro):
-                remaining.append(new_blob)
-    return unique(remaining)
-
-
-def unique(multilist):
-    '''Get list without repeating values.'''
-    return list(set(tuple(i) for i in multilist))
+    from scipy.spatial import cKDTree
+
+    new_blobs = np.asarray(new_blobs, dtype=float).reshape(-1, 3)
+    old_blobs = np.asarray(old_blobs, dtype=float).reshape(-1, 3)
+    if len(new_blobs) == 0 or len(old_blobs) == 0:
+        return new_blobs[:0]
+
+    # Find candidate pairs in neighbourhood of new blobs, the search radius is
+    # slightly enlarged so that candidates are never lost to rounding
+    radiuses = 2 * old_blobs[:, 2]
+    tree = cKDTree(old_blobs[:, :2])
+    neighbours = tree.query_ball_point(new_blobs[:, :2],
+                                       radiuses.max() * (1 + 1e-9) + 1e-9)
+    new_idx = np.repeat(np.arange(len(new_blobs)),
+                        [len(idx) for idx in neighbours])
+    old_idx = np.fromiter(chain.from_iterable(neighbours), dtype=int,
+                          count=len(new_idx))
+
+    # Keep only pairs that are strictly inside the proximity circle
+    yn, xn = new_blobs[new_idx, 0], new_blobs[new_idx, 1]
+    yo, xo = old_blobs[old_idx, 0], old_blobs[old_idx, 1]
+    is_inside = inside_circle(xn, yn, xo, yo, radiuses[old_idx])
+    return np.unique(new_blobs[new_idx[is_inside]], axis=0)
+
+
+def detect_blob_series(imgs, cache=None, detector='skimage_dog'):
+    '''
+    Return list of list of blobs detected independently in each of given
+    images, images may be given as iterator and are consumed one at a time.
+    '''
+    return [find_blobs(img, cache=cache, detector=detector) for img in imgs]
 
 
-def find_blob_series(imgs, only_remaining=True):
+def track_remaining_blobs(blobs_series):
     '''
-    Return list of list of blobs found in each of given images.
+    Turn blobs detected in consecutive images into list of list of blobs
+    remaining since the first image.
     '''
     stages = []
     remaining = None
-    for img in imgs:
-        new_blobs = find_blobs(img)
-        if remaining is not None and only_remaining:
+    for new_blobs in blobs_series:
+        if remaining is not None:
             remaining = find_remaining_blobs(new_blobs, remaining)
         else:
             remaining = new_blobs
@@ -61,40 +75,177 @@ def find_blob_series(imgs, only_remaining=True):
     return stages
 
 
+def find_blob_series(imgs, only_remaining=True, cache=None,
+                     detector='skimage_dog'):
+    '''
+    Return list of list of blobs found in each of given images, images may be
+    given as iterator, e.g. from iter_img_series.
+    '''
+    blobs_series = detect_blob_series(imgs, cache, detector)
+    if only_remaining:
+        return track_remaining_blobs(blobs_series)
+    return blobs_series
+
+
+class BlobTracker:
+    '''
+    Track blobs in stream of prepared images, e.g. from live camera, one
+    image at a time. After each image number of all blobs, remaining blobs
+    and ratio of remaining blobs to their initial number are available.
+    Counts are the same as count_blobs_in_series gives for whole series,
+    if the first image has no blobs, none remain and ratio is 0.
+    '''
+
+    def __init__(self, cache=None, detector='skimage_dog'):
+        self.cache = cache
+        self.detector = detector
+        self.remaining = None
+        self.counts_all = []
+        self.counts_rem = []
+        self.ratios_rem = []
+
+    def update(self, img):
+        '''Detect blobs in next image and get current counts.'''
+        blobs = find_blobs(img, cache=self.cache, detector=self.detector)
+        return self.update_blobs(blobs)
+
+    def update_blobs(self, blobs):
+        '''Track blobs detected in next image and get current counts.'''
+        if self.remaining is not None:
+            self.remaining = find_remaining_blobs(blobs, self.remaining)
+        else:
+            self.remaining = blobs
+        self.counts_all.append(len(blobs))
+        self.counts_rem.append(len(self.remaining))
+        self.ratios_rem.append(self.counts_rem[-1] / self.counts_rem[0]
+                               if self.counts_rem[0] else 0.0)
+        return self.counts_all[-1], self.counts_rem[-1], self.ratios_rem[-1]
+
+
+def ratio_to_first(counts):
+    '''
+    Divide counts by the first one along last axis, ratio is 0 where
+    the first count is 0.
+    '''
+    counts = np.asarray(counts, dtype=float)
+    first = counts[..., :1]
+    return np.divide(counts, first, out=np.zeros_like(counts),
+                     where=first > 0)
+
+
 def ratio_of_remaining_blobs_in_stages(stages):
     '''
     In each stage calculate ratio of remaining blobs to their initial number.
     '''
-    num_of_blobs = [len(stage) for stage in stages]
-    return [remaining / num_of_blobs[0] for remaining in num_of_blobs]
+    return ratio_to_first([len(stage) for stage in stages])
 
 
-def count_blobs_with_all_methods(X):
+def count_blobs_in_series(blobs_series):
     '''
-    Get number of blobs in all images in X data set
-    using three ways of counting.
+    Get number of blobs in single series of detections using three ways of
+    counting: all, remaining and remaining ratio.
     '''
-    # Option one: all
-    Xa = [[
-        len(stage)
-        for stage in find_blob_series(img_series, only_remaining=False)
-    ] for img_series in X]
+    stages_rem = track_remaining_blobs(blobs_series)
+    count_all = np.array([len(stage) for stage in blobs_series])
+    count_rem = np.array([len(stage) for stage in stages_rem])
+    return count_all, count_rem, ratio_to_first(count_rem)
+
 
-    # Option two: remaining
-    Xr = [[
-        len(stage) for stage in find_blob_series(img_series)
-    ] for img_series in X]
+def resample_series(values, n_frames):
+    '''
+    Linearly interpolate values recorded in equally spaced frames, given along
+    last axis, to n_frames equally spaced frames spanning the same time.
+    '''
+    values = np.asarray(values, dtype=float)
+    positions = np.linspace(0, values.shape[-1] - 1, n_frames)
+    low = np.floor(positions).astype(int)
+    high = np.minimum(low + 1, values.shape[-1] - 1)
+    weight = positions - low
+    return values[..., low] * (1 - weight) + values[..., high] * weight
 
-    # Option three: remaining ratio
-    Xp = [
-        ratio_of_remaining_blobs_in_stages(find_blob_series(img_series))
+
+def stack_counts(counts, n_frames=None):
+    '''
+    Stack counts of many series, as given by count_blobs_in_series, into
+    arrays of all, remaining and ratio counts shaped (samples, frames).
+    Series are resampled to n_frames if given, which allows series of
+    different lengths.
+    '''
+    Xa = [count_all for count_all, _, _ in counts]
+    Xr = [count_rem for _, count_rem, _ in counts]
+    if n_frames is not None:
+        Xa = [resample_series(count_all, n_frames) for count_all in Xa]
+        Xr = [resample_series(count_rem, n_frames) for count_rem in Xr]
+    Xa, Xr = np.array(Xa), np.array(Xr)
+    Xp = ratio_to_first(Xr)
+    return Xa, Xr, Xp
+
+
+def count_blobs_with_all_methods(X, cache=None, detector='skimage_dog',
+                                 n_frames=None):
+    '''
+    Get number of blobs in all images in X data set
+    using three ways of counting.
+    '''
+    # Detect blobs only once per image and count them in all ways
+    counts = [
+        count_blobs_in_series(detect_blob_series(img_series, cache, detector))
         for img_series in X
     ]
-    return Xa, Xr, Xp
+    return stack_counts(counts, n_frames)
+
+
+def detect_img_series(path, cache=None, detector='skimage_dog'):
+    '''
+    Load image series matching path, prepare it and detect blobs in each
+    of its images.
+    '''
+    imgs_prep = iter_img_series(path, fast_prepare)
+    return detect_blob_series(imgs_prep, cache, detector)
+
+
+def detect_blob_series_parallel(paths, max_workers=None, cache=None,
+                                detector='skimage_dog'):
+    '''
+    Detect blobs in image series matching paths, each series is loaded and
+    processed in separate process. Results are ordered the same way as paths.
+    '''
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        detect_series = partial(detect_img_series, cache=cache,
+                                detector=detector)
+        return list(executor.map(detect_series, paths))
+
+
+def count_blobs_in_img_series(path, cache=None, detector='skimage_dog'):
+    '''
+    Load image series matching path, prepare it and count blobs in it
+    using three ways of counting.
+    '''
+    return count_blobs_in_series(detect_img_series(path, cache, detector))
+
+
+def count_blobs_with_all_methods_parallel(paths, max_workers=None,
+                                          cache=None, detector='skimage_dog',
+                                          n_frames=None):
+    '''
+    Get number of blobs in image series matching paths using three ways of
+    counting, each series is loaded and processed in separate process.
+    Results are ordered the same way as paths.
+    '''
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        count_series = partial(count_blobs_in_img_series, cache=cache,
+                               detector=detector)
+        counts = list(executor.map(count_series, paths))
+    return stack_counts(counts, n_frames)
 
 
 def main():
     '''Demo blob tracking with various ways of counting blobs.'''
+    import matplotlib.pyplot as plt
+    from skimage.color import rgb2gray
+
+    from plotting import patch_plot_legend_outside, plot_blobs
+
     # Load images
     imgs = load_img_series('img/104_E5R')
     # Prepare images for processing
@@ -102,8 +253,10 @@ def main():
     # Prepare cropped images for displaying
     imgs_crop = [crop_ui(rgb2gray(img)) for img in imgs]
 
-    # Find blobs for stages of cooling with preserving only remainig ones
-    stages_rem = find_blob_series(imgs_prep)
+    # Detect blobs once and track stages of cooling preserving only
+    # remainig ones
+    stages_all = detect_blob_series(imgs_prep, BlobCache())
+    stages_rem = track_remaining_blobs(stages_all)
 
     # Map stages on first image
     colors = ('blue', 'blueviolet', 'magenta', 'crimson', 'red')
@@ -111,10 +264,7 @@ def main():
     plt.title("Blobs detection with DoH")
     plt.imshow(imgs_crop[0], cmap=plt.get_cmap('gray'))
     for stage, color in zip(stages_rem, colors):
-        for blob in stage:
-            y, x, r = blob
-            c = plt.Circle((x, y), r, color=color, linewidth=0.75, fill=False)
-            ax.add_patch(c)
+        plot_blobs(ax, stage, color)
     labels = ('Minute 0', 'Minute 1', 'Minute 2', 'Minute 3', 'Minute 4')
     patch_plot_legend_outside(colors, labels)
     print(ratio_of_remaining_blobs_in_stages(stages_rem))
@@ -126,16 +276,11 @@ def main():
     for idx, (stage, img) in enumerate(zip(stages_rem, imgs_crop)):
         ax[idx].imshow(img, cmap=plt.get_cmap('gray'))
         ax[idx].set_title("Minute: {}, blobs: {}".format(idx, len(stage)))
-        for blob in stage:
-            y, x, r = blob
-            c = plt.Circle((x, y), r, color='r', linewidth=0.75, fill=False)
-            ax[idx].add_patch(c)
+        plot_blobs(ax[idx], stage)
     ax[-1].set_axis_off()
     plt.tight_layout()
 
-    # Find all blobs for every stage of cooling
-    stages_all = find_blob_series(imgs_prep, only_remaining=False)
-
+    # Show all blobs for every stage of cooling
     # Show stages on subplots
     _, ax = plt.subplots(2, 3, figsize=(12, 7))
     ax = ax.flatten()
@@ -143,10 +288,7 @@ def main():
     for idx, (stage, img) in enumerate(zip(stages_all, imgs_crop)):
         ax[idx].imshow(img, cmap=plt.get_cmap('gray'))
         ax[idx].set_title("Minute: {}, blobs: {}".format(idx, len(stage)))
-        for blob in stage:
-            y, x, r = blob
-            c = plt.Circle((x, y), r, color='r', linewidth=0.75, fill=False)
-            ax[idx].add_patch(c)
+        plot_blobs(ax[idx], stage)
     ax[-1].set_axis_off()
     plt.tight_layout()
 
@@ -160,14 +302,8 @@ def main():
         ax[idx].imshow(img, cmap=plt.get_cmap('gray'))
         ax[idx].set_title("Minute: {}, all blobs: {}, rem blobs: {}".
                           format(idx, len(stage_all), len(stage_rem)))
-        for blob_all in stage_all:
-            y, x, r = blob_all
-            c = plt.Circle((x, y), r, color='b', linewidth=0.75, fill=False)
-            ax[idx].add_patch(c)
-        for blob_rem in stage_rem:
-            y, x, r = blob_rem
-            c = plt.Circle((x, y), r, color='r', linewidth=0.75, fill=False)
-            ax[idx].add_patch(c)
+        plot_blobs(ax[idx], stage_all, 'b')
+        plot_blobs(ax[idx], stage_rem, 'r')
     ax[-1].set_axis_off()
     plt.tight_layout()
 
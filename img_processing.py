@@ -1,87 +1,409 @@
-'''Supporting functions for image preprocessng, data loading and labeling.'''
+'''
+Supporting functions for image preprocessng, data loading and labeling.
+Heavy dependencies, skimage, PIL and pytesseract, are imported only inside
+functions that need them, so that workers importing this module start fast.
+'''
 
 import glob
+import hashlib
+import os
+import time
+import timeit
 
-import matplotlib.pyplot as plt
 import natsort
 import numpy as np
-from PIL import Image
-import pytesseract
-from skimage.color import rgb2gray
-from skimage.exposure import histogram
-from skimage.filters import threshold_otsu
-from skimage.io import imread
-from skimage.transform import rescale
-from skimage.util import invert, crop
-
-
-def show_with_hist(img, title):
-    '''Plot imgage alongside its histogram.'''
-    plt.figure()
-    plt.subplot(121)
-    plt.imshow(img, cmap=plt.get_cmap('gray'))
-    plt.title(title)
-    hist, bins_center = histogram(img)
-    plt.subplot(122)
-    plt.plot(bins_center, hist, lw=2)
+
+from instrumentation import count, timed, timer
+
+
+UI_CROP_WIDTH = ((27, 19), (25, 37))
+GRAY_COEFFS = (0.2125, 0.7154, 0.0721)
+TEMPERATURE_BOUNDS = (((6, 24), (283, 318)),
+                      ((219, 236), (283, 318)))
+# Rows and columns of tens, units and tenths digits in temperature bounds
+DIGITS_ROWS = (2, 14)
+DIGITS_COLS = ((1, 10), (10, 19), (23, 32))
 
 
 def crop_ui(img):
     '''Remove FLIR camera UI from image'''
-    img_cropped = crop(img, ((27, 19), (25, 37)))
+    from skimage.util import crop
+
+    img_cropped = crop(img, UI_CROP_WIDTH)
     return img_cropped
 
 
-def get_temperature_bounds(img, bounds=(((6, 24), (283, 318)),
-                                        ((219, 236), (283, 318)))):
-    '''Extract temperature values from FLIR UI on image.'''
+def content_hash(img, **params):
+    '''Get hash of image content, shape and given parameters.'''
+    img = np.ascontiguousarray(img)
+    digest = hashlib.sha1(img.tobytes())
+    digest.update(repr((img.shape, img.dtype.str)).encode())
+    digest.update(repr(sorted(params.items())).encode())
+    return digest.hexdigest()
+
+
+def temperature_txt_imgs(img, bounds=TEMPERATURE_BOUNDS):
+    '''Get binarized and rescaled temperature values from FLIR UI on image.'''
+    from skimage.filters import threshold_otsu
+    from skimage.transform import rescale
+    from skimage.util import invert
+
     img = invert(img)
-    temp_txt = []
+    txt_imgs = []
     for bound in bounds:
         bound_img = img[slice(*bound[0]), slice(*bound[1])]
         bound_img = rescale(bound_img, 4, anti_aliasing=True)
         thr = threshold_otsu(bound_img)
-        img_txt = bound_img > thr
+        txt_imgs.append(bound_img > thr)
+    return txt_imgs
+
+
+def parse_temperature(txt):
+    '''Turn text read from FLIR UI into temperature value.'''
+    txt = txt.strip()
+    if txt != '':
+        return float(txt) / 10
+    return 0
+
+
+@timed()
+def get_temperature_bounds(img, bounds=TEMPERATURE_BOUNDS):
+    '''Extract temperature values from FLIR UI on image.'''
+    from PIL import Image
+    import pytesseract
+
+    temp_txt = []
+    for img_txt in temperature_txt_imgs(img, bounds):
         img_txt = Image.fromarray(img_txt)
-        temp = pytesseract.image_to_string(img_txt, config='digits')
-        if temp != '':
-            temp = float(temp) / 10
-        else:
-            temp = 0
-        temp_txt.append(temp)
+        with timer('tesseract'):
+            temp = pytesseract.image_to_string(img_txt, config='digits')
+        temp_txt.append(parse_temperature(temp))
     return temp_txt
 
 
+def read_temperatures(txt_imgs, gap=16):
+    '''
+    Read temperature values from many binarized images with single tesseract
+    call, by stacking them one under another into one page of text lines.
+    '''
+    from PIL import Image
+    import pytesseract
+
+    width = max(img_txt.shape[1] for img_txt in txt_imgs)
+    lines = []
+    for img_txt in txt_imgs:
+        # Pad with background, which is the dominant value of text image
+        background = img_txt.mean() > 0.5
+        pad_width = ((gap, gap), (gap, width - img_txt.shape[1] + gap))
+        lines.append(np.pad(img_txt, pad_width, mode='constant',
+                            constant_values=background))
+    page = Image.fromarray(np.concatenate(lines))
+    with timer('tesseract'):
+        txt = pytesseract.image_to_string(page, config='--psm 6 digits')
+    txt_lines = [line for line in txt.splitlines() if line.strip() != '']
+
+    # Fall back to reading images one by one if lines got merged or lost
+    if len(txt_lines) != len(txt_imgs):
+        with timer('tesseract'):
+            txt_lines = [
+                pytesseract.image_to_string(Image.fromarray(img_txt),
+                                            config='digits')
+                for img_txt in txt_imgs
+            ]
+    return [parse_temperature(line) for line in txt_lines]
+
+
+def temperature_glyphs(img, bounds=TEMPERATURE_BOUNDS):
+    '''
+    Get digits of temperature values from FLIR UI on image as array of
+    flattened glyphs with zero mean and unit norm, shaped (bounds, digits,
+    pixels).
+    '''
+    glyphs = np.array([
+        [img[bound[0][0] + DIGITS_ROWS[0]:bound[0][0] + DIGITS_ROWS[1],
+             bound[1][0] + cols[0]:bound[1][0] + cols[1]]
+         for cols in DIGITS_COLS]
+        for bound in bounds
+    ], dtype=float)
+    glyphs = glyphs.reshape(glyphs.shape[:2] + (-1,))
+    glyphs -= glyphs.mean(axis=-1, keepdims=True)
+    norms = np.linalg.norm(glyphs, axis=-1, keepdims=True)
+    return np.divide(glyphs, norms, out=np.zeros_like(glyphs),
+                     where=norms > 0)
+
+
+def temperature_digits(temp):
+    '''
+    Get tens, units and tenths digits of temperature value or None if it
+    does not fit FLIR UI digits layout.
+    '''
+    digits = '{:.1f}'.format(temp).replace('.', '')
+    if len(digits) != len(DIGITS_COLS) or not digits.isdigit():
+        return None
+    return [int(digit) for digit in digits]
+
+
+class DigitReader:
+    '''
+    Read temperature values from FLIR UI on grayscale image by correlating
+    its digits with glyph templates learned from images with known values.
+    Values with any digit matching worse than min_score are returned as None.
+    '''
+
+    def __init__(self, templates, bounds=TEMPERATURE_BOUNDS, min_score=0.7):
+        self.templates = templates
+        self.bounds = bounds
+        self.min_score = min_score
+
+    @classmethod
+    def learn(cls, imgs, temps, **kwargs):
+        '''Learn glyph templates from images and values read from them.'''
+        reader = cls(None, **kwargs)
+        glyphs_sum = 0
+        for img, img_temps in zip(imgs, temps):
+            glyphs = temperature_glyphs(img, reader.bounds)
+            for bound_glyphs, temp in zip(glyphs, img_temps):
+                digits = temperature_digits(temp)
+                if digits is not None:
+                    one_hot = np.eye(10)[digits]
+                    glyphs_sum = glyphs_sum + one_hot.T @ bound_glyphs
+        # Average glyphs of each digit, digits never seen stay zero
+        norms = np.linalg.norm(glyphs_sum, axis=-1, keepdims=True)
+        reader.templates = np.divide(glyphs_sum, norms,
+                                     out=np.zeros_like(glyphs_sum),
+                                     where=norms > 0)
+        return reader
+
+    @classmethod
+    def load(cls, path, **kwargs):
+        '''Load reader with glyph templates from .npz file.'''
+        with np.load(path) as data:
+            return cls(data['templates'], **kwargs)
+
+    def save(self, path):
+        '''Save glyph templates to .npz file.'''
+        np.savez_compressed(path, templates=self.templates)
+
+    def __call__(self, img):
+        '''Read temperature values from FLIR UI on image.'''
+        scores = temperature_glyphs(img, self.bounds) @ self.templates.T
+        digits = scores.argmax(axis=-1)
+        is_read = (scores.max(axis=-1) >= self.min_score).all(axis=-1)
+        temps = digits @ (100, 10, 1) / 10
+        return [float(temp) if read else None
+                for temp, read in zip(temps, is_read)]
+
+
+def default_digit_reader(path='.img_cache/digit_templates.npz'):
+    '''
+    Get DigitReader with glyph templates stored in path. If there are none,
+    learn them once from values read with tesseract on default set images.
+    '''
+    from skimage.color import rgb2gray
+
+    if os.path.exists(path):
+        return DigitReader.load(path)
+
+    paths, _ = default_img_set_paths()
+    imgs = [img for series_path in paths
+            for img in iter_img_series(series_path, rgb2gray)]
+    temps = [get_temperature_bounds(img) for img in imgs]
+    reader = DigitReader.learn(imgs, temps)
+
+    templates_dir = os.path.dirname(path)
+    if templates_dir:
+        os.makedirs(templates_dir, exist_ok=True)
+    reader.save(path)
+    return reader
+
+
+def get_temperature_bounds_batch(imgs, bounds=TEMPERATURE_BOUNDS, cache=None,
+                                 reader=None, batch_size=32):
+    '''
+    Extract temperature values from FLIR UI on many images, reading batch_size
+    values with single tesseract call. Values are first read with reader
+    if given, e.g. DigitReader, which returns None for values it cannot read.
+    Results are stored in cache mapping, e.g. dict or shelve, under image
+    content hash.
+    '''
+    temps = []
+    missing_keys = []
+    pending = []
+    for i, img in enumerate(imgs):
+        if cache is not None:
+            key = content_hash(img, bounds=bounds)
+            if key in cache:
+                temps.append(list(cache[key]))
+                continue
+            missing_keys.append((i, key))
+
+        if reader is not None:
+            temps.append(reader(img))
+        else:
+            temps.append([None] * len(bounds))
+        if None in temps[i]:
+            for j, img_txt in enumerate(temperature_txt_imgs(img, bounds)):
+                if temps[i][j] is None:
+                    pending.append((i, j, img_txt))
+
+    for start in range(0, len(pending), batch_size):
+        batch = pending[start:start + batch_size]
+        batch_temps = read_temperatures([img_txt for _, _, img_txt in batch])
+        for (i, j, _), temp in zip(batch, batch_temps):
+            temps[i][j] = temp
+
+    for i, key in missing_keys:
+        cache[key] = temps[i]
+    return temps
+
+
+@timed()
 def full_prepare(img):
     '''Pipeline for FLIR images, convert to grayscale, crop ui and invert.'''
-    img_gray = rgb2gray(img)
+    from skimage.color import rgb2gray
+    from skimage.util import invert
+
+    with timer('rgb2gray'):
+        img_gray = rgb2gray(img)
     img_crop = crop_ui(img_gray)
     img_prep = invert(img_crop)
     return img_prep
 
 
+@timed()
+def fast_prepare(imgs, dtype=np.float64, out=None):
+    '''
+    Fused equivalent of full_prepare working on single RGB image or stack
+    of them with shape (N, H, W, 3). UI is cropped away first using a view,
+    so only remaining pixels are converted to grayscale and inverted, result
+    is written to out array if given. Unlike full_prepare, grayscale images
+    are not supported.
+    '''
+    if imgs.ndim < 3 or imgs.shape[-1] != 3:
+        raise ValueError('Expected RGB image or stack of them with shape '
+                         '(..., H, W, 3), got {}'.format(imgs.shape))
+    (top, bottom), (left, right) = UI_CROP_WIDTH
+    height, width = imgs.shape[-3:-1]
+    roi = imgs[..., top:height - bottom, left:width - right, :]
+
+    # Fold conversion of integer pixels to [0, 1] range into coefficients
+    coeffs = np.array(GRAY_COEFFS)
+    if np.issubdtype(imgs.dtype, np.integer):
+        coeffs = coeffs / np.iinfo(imgs.dtype).max
+    coeffs = coeffs.astype(dtype)
+
+    img_prep = np.matmul(roi, coeffs, out=out, dtype=dtype,
+                         casting='same_kind')
+    return np.subtract(1, img_prep, out=img_prep)
+
+
+def img_series_paths(path):
+    '''Get naturally sorted paths of jpg images containing glob pattern.'''
+    imgs = glob.glob(path + '*.jpg')
+    return natsort.natsorted(imgs)
+
+
+def iter_img_series(path, prepare=None):
+    '''
+    Lazily load jpg images containing glob pattern in path one at a time,
+    optionally passing each of them through prepare function.
+    '''
+    from skimage.io import imread
+
+    for img_path in img_series_paths(path):
+        with timer('decode_jpeg'):
+            img = imread(img_path)
+        count('frames_loaded')
+        yield img if prepare is None else prepare(img)
+
+
+def replay_img_series(path, prepare=None, fps=30):
+    '''
+    Yield images containing glob pattern in path at given frame rate,
+    standing in for live camera stream.
+    '''
+    period = 1 / fps
+    next_time = time.monotonic()
+    for img in iter_img_series(path, prepare):
+        delay = next_time - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        next_time += period
+        yield img
+
+
 def load_img_series(path):
     '''
     Load jpg images containing glob pattern in path and get them in array.
     '''
-    imgs = glob.glob(path + '*.jpg')
-    imgs = natsort.natsorted(imgs)
-    return [imread(img) for img in imgs]
+    return list(iter_img_series(path))
 
 
-def default_img_set():
+def default_img_set_paths():
     '''
-    Get default set of metal grains cooling down recorded with FLIR
-    thermovision camera.
+    Get paths of image series in default set of metal grains cooling down
+    recorded with FLIR thermovision camera.
     '''
     samples_names = ('104_E5R', '113_E5R', '119_E5R',
                      '107_E6R', '108_E6R', '117_E6R',
                      '105_E11R', '106_E11R', '115_E11R',
                      '111_E16R', '112_E16R', '118_E16R')
 
-    X = [load_img_series('img/' + name) for name in samples_names]
+    paths = ['img/' + name for name in samples_names]
     labels = (name.split('_', 1)[1] for name in samples_names)
     y = encode_labels(labels)
+    return [paths, y]
+
+
+def default_img_set():
+    '''
+    Get default set of metal grains cooling down recorded with FLIR
+    thermovision camera.
+    '''
+    paths, y = default_img_set_paths()
+    X = [load_img_series(path) for path in paths]
+    return [X, y]
+
+
+def save_img_set_array(paths, array_path):
+    '''
+    Decode image series matching paths once and save them in .npy file
+    as single contiguous array with shape (samples, frames, H, W, 3).
+    All series must have the same number of equally sized images.
+    '''
+    first_series = load_img_series(paths[0])
+    shape = (len(paths), len(first_series)) + first_series[0].shape
+
+    array_dir = os.path.dirname(array_path)
+    if array_dir:
+        os.makedirs(array_dir, exist_ok=True)
+    # Fill temporary memory map series by series and move it in place after
+    tmp_path = array_path + '.tmp.npy'
+    X = np.lib.format.open_memmap(tmp_path, mode='w+',
+                                  dtype=first_series[0].dtype, shape=shape)
+    for i, path in enumerate(paths):
+        for j, img in enumerate(iter_img_series(path)):
+            X[i, j] = img
+    X.flush()
+    del X
+    os.replace(tmp_path, array_path)
+
+
+def default_img_set_array(array_path='.img_cache/default_img_set.npy'):
+    '''
+    Get default set of metal grains cooling down as (samples, frames, H, W, 3)
+    array memory-mapped from .npy file. The file is built from jpg images
+    on first use and rebuilt when any of them is newer.
+    '''
+    paths, y = default_img_set_paths()
+    img_paths = [img_path for path in paths
+                 for img_path in img_series_paths(path)]
+    if (not os.path.exists(array_path) or
+            max(map(os.path.getmtime, img_paths)) >
+            os.path.getmtime(array_path)):
+        save_img_set_array(paths, array_path)
+
+    X = np.load(array_path, mmap_mode='r')
     return [X, y]
 
 
@@ -95,3 +417,29 @@ def encode_labels(y_labels):
     '''Turn grain samples names into numeric labels.'''
     y = {'E5R': 0, 'E6R': 1, 'E11R': 2, 'E16R': 3}
     return [y[label] for label in y_labels]
+
+
+def main():
+    '''Compare speed of default and fused image preparation.'''
+    imgs = np.stack(load_img_series('img/104_E5R'))
+    out = np.empty(imgs.shape[:1] + crop_ui(imgs[0, ..., 0]).shape,
+                   dtype=np.float32)
+
+    runs = 200
+    timings = (
+        ('full_prepare', lambda: [full_prepare(img) for img in imgs]),
+        ('fast_prepare', lambda: [fast_prepare(img) for img in imgs]),
+        ('fast_prepare float32 out',
+         lambda: [fast_prepare(img, np.float32, out[i])
+                  for i, img in enumerate(imgs)]),
+        ('fast_prepare batch', lambda: fast_prepare(imgs)),
+        ('fast_prepare batch float32 out',
+         lambda: fast_prepare(imgs, np.float32, out)),
+    )
+    for name, prepare in timings:
+        duration = timeit.timeit(prepare, number=runs) / runs / len(imgs)
+        print('{}: {:.1f} us per image'.format(name, duration * 1e6))
+
+
+if __name__ == '__main__':
+    main()
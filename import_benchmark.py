@@ -0,0 +1,53 @@
+'''Measure time of importing project modules in fresh interpreters.'''
+
+import os
+import subprocess
+import sys
+
+
+# Import time budgets in seconds, modules imported by headless detection
+# workers must start well under a second, others are only reported
+IMPORT_BUDGETS = {
+    'img_processing': 0.5,
+    'blob_finder': 0.5,
+    'blob_series_tracker': 0.5,
+    'numpy_network': 0.5,
+    'plotting': None,
+    'neural_network': None,
+    'thesis_generator': None,
+}
+
+
+def import_time(module, repeat=5):
+    '''Get best of repeat times of importing module in fresh interpreter.'''
+    code = ('import time; start = time.perf_counter(); import {}; '
+            'print(time.perf_counter() - start)'.format(module))
+    times = []
+    for _ in range(repeat):
+        result = subprocess.run(
+            [sys.executable, '-c', code], check=True, stdout=subprocess.PIPE,
+            universal_newlines=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)))
+        times.append(float(result.stdout.splitlines()[-1]))
+    return min(times)
+
+
+def main():
+    '''Report import times and fail if any module exceeds its budget.'''
+    over_budget = []
+    for module, budget in IMPORT_BUDGETS.items():
+        duration = import_time(module)
+        if budget is None:
+            print('{}: {:.3f} s'.format(module, duration))
+            continue
+        print('{}: {:.3f} s (budget {:.1f} s)'.format(module, duration,
+                                                      budget))
+        if duration > budget:
+            over_budget.append(module)
+
+    if over_budget:
+        sys.exit('Over import time budget: ' + ', '.join(over_budget))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,232 @@
+'''
+Opt-in timers and counters of pipeline stages with pluggable report sinks.
+While disabled, which is the default, hooks only check one flag, so they
+can stay in hot code paths. Only the current process is recorded, work
+done in worker processes of parallel functions is not.
+'''
+
+from contextlib import contextmanager
+from functools import wraps
+import json
+import logging
+import os
+import threading
+import time
+
+
+_enabled = False
+_lock = threading.Lock()
+# Name of timer mapped to list of calls, total, min and max seconds
+_timers = {}
+_counters = {}
+_start_time = None
+
+
+def enable():
+    '''Start recording timers and counters.'''
+    global _enabled, _start_time
+    if _start_time is None:
+        _start_time = time.perf_counter()
+    _enabled = True
+
+
+def disable():
+    '''Stop recording, recorded values are kept until reset.'''
+    global _enabled
+    _enabled = False
+
+
+def is_enabled():
+    '''Check if timers and counters are being recorded.'''
+    return _enabled
+
+
+def reset():
+    '''Forget all recorded values.'''
+    global _start_time
+    with _lock:
+        _timers.clear()
+        _counters.clear()
+        _start_time = time.perf_counter() if _enabled else None
+
+
+def record_time(name, seconds):
+    '''Add single measured duration to timer with given name.'''
+    with _lock:
+        stats = _timers.get(name)
+        if stats is None:
+            _timers[name] = [1, seconds, seconds, seconds]
+        else:
+            stats[0] += 1
+            stats[1] += seconds
+            stats[2] = min(stats[2], seconds)
+            stats[3] = max(stats[3], seconds)
+
+
+def count(name, value=1):
+    '''Increase counter with given name, e.g. of frames or blobs.'''
+    if not _enabled:
+        return
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+
+
+class timer:
+    '''Context manager measuring time of its block under given name.'''
+
+    __slots__ = ('name', 'start')
+
+    def __init__(self, name):
+        self.name = name
+        self.start = None
+
+    def __enter__(self):
+        if _enabled:
+            self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.start is not None:
+            record_time(self.name, time.perf_counter() - self.start)
+
+
+def timed(name=None):
+    '''
+    Decorator measuring time of each call of function under given name,
+    by default its qualified name.
+    '''
+    def decorator(func):
+        timer_name = name or func.__qualname__
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return func(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                record_time(timer_name, time.perf_counter() - start)
+        return wrapper
+    return decorator
+
+
+def profile_report():
+    '''Get recorded timers and counters as JSON serializable dict.'''
+    with _lock:
+        timers = {
+            name: {'calls': calls, 'total_seconds': total,
+                   'mean_seconds': total / calls, 'min_seconds': low,
+                   'max_seconds': high}
+            for name, (calls, total, low, high) in sorted(_timers.items())
+        }
+        counters = dict(sorted(_counters.items()))
+    wall = time.perf_counter() - _start_time if _start_time else 0
+    return {'wall_seconds': wall, 'timers': timers, 'counters': counters}
+
+
+def format_report(report):
+    '''Get report as text table, timers sorted by total time.'''
+    lines = ['wall time: {:.3f} s'.format(report['wall_seconds'])]
+    timers = sorted(report['timers'].items(),
+                    key=lambda item: -item[1]['total_seconds'])
+    for name, stats in timers:
+        lines.append('{:<32} {:>8} calls {:>10.3f} s {:>10.3f} ms/call'.format(
+            name, stats['calls'], stats['total_seconds'],
+            stats['mean_seconds'] * 1e3))
+    for name, value in report['counters'].items():
+        lines.append('{:<32} {:>8g}'.format(name, value))
+    return '\n'.join(lines)
+
+
+class LogSink:
+    '''Write report as log lines.'''
+
+    def __init__(self, logger=None, level=logging.INFO):
+        self.logger = logger or logging.getLogger(__name__)
+        self.level = level
+
+    def emit(self, report):
+        for line in format_report(report).splitlines():
+            self.logger.log(self.level, line)
+
+
+class JsonSink:
+    '''Write report to JSON file.'''
+
+    def __init__(self, path):
+        self.path = path
+
+    def emit(self, report):
+        _make_parent_dir(self.path)
+        with open(self.path, 'w') as report_file:
+            json.dump(report, report_file, indent=2)
+
+
+class PrometheusSink:
+    '''Write report to file in Prometheus text exposition format.'''
+
+    def __init__(self, path, prefix='grains'):
+        self.path = path
+        self.prefix = prefix
+
+    def emit(self, report):
+        metric = self.prefix + '_stage_seconds'
+        lines = ['# TYPE {} summary'.format(metric)]
+        for name, stats in report['timers'].items():
+            lines.append('{}_sum{{stage="{}"}} {}'.format(
+                metric, name, stats['total_seconds']))
+            lines.append('{}_count{{stage="{}"}} {}'.format(
+                metric, name, stats['calls']))
+        metric = self.prefix + '_events_total'
+        lines.append('# TYPE {} counter'.format(metric))
+        for name, value in report['counters'].items():
+            lines.append('{}{{event="{}"}} {}'.format(metric, name, value))
+        lines.append('# TYPE {}_run_seconds gauge'.format(self.prefix))
+        lines.append('{}_run_seconds {}'.format(self.prefix,
+                                                report['wall_seconds']))
+
+        _make_parent_dir(self.path)
+        with open(self.path, 'w') as metrics_file:
+            metrics_file.write('\n'.join(lines) + '\n')
+
+
+def _make_parent_dir(path):
+    parent_dir = os.path.dirname(path)
+    if parent_dir:
+        os.makedirs(parent_dir, exist_ok=True)
+
+
+@contextmanager
+def profile(*sinks):
+    '''
+    Record timers and counters of code run in block from scratch and emit
+    report to each of given sinks at its end.
+    '''
+    enable()
+    reset()
+    try:
+        yield
+    finally:
+        disable()
+        report = profile_report()
+        for sink in sinks:
+            sink.emit(report)
+
+
+def main():
+    '''Profile blob detection and tracking on default set.'''
+    from blob_series_tracker import count_blobs_with_all_methods
+    from img_processing import default_img_set, full_prepare
+    # Hooks record into imported module, not into this one run as script
+    import instrumentation
+
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    with instrumentation.profile(instrumentation.LogSink()):
+        X, _ = default_img_set()
+        X = [[full_prepare(img) for img in img_series] for img_series in X]
+        count_blobs_with_all_methods(X)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,20 +1,37 @@
 '''Model and validation for grain classifier using blob detection.'''
 
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from functools import partial
+import hashlib
+from itertools import product
+import json
+from multiprocessing import get_context
+import os
+import time
+
 import numpy as np
-from sklearn.model_selection import StratifiedKFold
+from sklearn.model_selection import StratifiedKFold, train_test_split
 import tensorflow as tf
 from tensorflow import keras
 
+from instrumentation import timer
+
 
 tf.keras.backend.set_floatx('float64')
 
+CrossValidationResult = namedtuple(
+    'CrossValidationResult',
+    ('loss', 'accuracy', 'test_indices', 'predictions', 'conf_matrix'))
+
 
-def default_grain_classifier_model():
+def default_grain_classifier_model(n_frames=5):
     '''
     Get default uncompiled model for grain classifcation,
-    based on 5 step cooling process using number of blobs.
+    based on 5 step cooling process using number of blobs in n_frames frames.
     '''
     model = keras.Sequential([
+        keras.Input(shape=(n_frames,)),
         keras.layers.Dense(5, activation='tanh'),
         keras.layers.Dense(256, activation='tanh'),
         keras.layers.Dense(128, activation='tanh'),
@@ -23,33 +40,314 @@ def default_grain_classifier_model():
     return model
 
 
-def network_cross_validation(model, X, y, n_splits):
-    '''Compute cross validation fold scores for given keras model.'''
-    eval_scores = []
+def grain_classifier_model(activation='tanh', hidden_layers=(256, 128),
+                           optimizer='adam', n_frames=5, dtype=None):
+    '''
+    Get compiled model for grain classifcation with given activation function
+    and numbers of neurons in hidden layers, taking number of blobs in
+    n_frames frames. Layers compute in dtype, e.g. 'float32', instead of
+    default float64 if given.
+    '''
+    model = keras.Sequential(
+        [keras.Input(shape=(n_frames,)),
+         keras.layers.Dense(5, activation=activation, dtype=dtype)] +
+        [keras.layers.Dense(neurons, activation=activation, dtype=dtype)
+         for neurons in hidden_layers] +
+        [keras.layers.Dense(4, activation='softmax', dtype=dtype)])
+    model.compile(
+        optimizer=optimizer,
+        loss='sparse_categorical_crossentropy',
+        metrics=['accuracy'])
+    return model
 
-    folds = StratifiedKFold(n_splits=n_splits).split(X, y)
-    for train_index, test_index in folds:
-        x_train, x_test = X[train_index], X[test_index]
-        y_train, y_test = y[train_index], y[test_index]
 
-        model.fit(x_train, y_train, epochs=300, verbose=0)
-        eval_scores.append(model.evaluate(x_test, y_test, verbose=0))
-    return eval_scores
+class _ValidationLoss(keras.callbacks.Callback):
+    '''
+    Put loss on held out data into epoch logs as val_loss. Small validation
+    set is predicted directly, which is much cheaper than validation_data
+    evaluated by fit after every epoch.
+    '''
+
+    def __init__(self, x_val, y_val):
+        super().__init__()
+        self.x_val = x_val
+        self.y_val = y_val
+
+    def on_epoch_end(self, epoch, logs=None):
+        loss = keras.losses.get(self.model.loss)
+        y_pred = self.model(self.x_val, training=False)
+        logs['val_loss'] = float(np.mean(loss(self.y_val, y_pred)))
+
+
+def fit_model(model, x_train, y_train, epochs=300, full_batch=False,
+              patience=None, validation_size=0.25):
+    '''
+    Train model for given number of epochs, optionally using whole training
+    set as single batch. If patience is given, validation_size part of
+    training set is held out and training stops once validation loss has not
+    improved for patience epochs, restoring the best weights.
+    '''
+    callbacks = []
+    if patience is not None:
+        # Hold out at least one sample of each class
+        n_classes = len(np.unique(y_train))
+        n_val = max(int(round(validation_size * len(y_train))), n_classes)
+        x_train, x_val, y_train, y_val = train_test_split(
+            x_train, y_train, test_size=n_val, stratify=y_train,
+            random_state=0)
+        callbacks.append(_ValidationLoss(x_val, y_val))
+        callbacks.append(keras.callbacks.EarlyStopping(
+            patience=patience, restore_best_weights=True))
+
+    batch_size = len(x_train) if full_batch else None
+    with timer('keras_fit'):
+        return model.fit(x_train, y_train, epochs=epochs,
+                         batch_size=batch_size, callbacks=callbacks,
+                         verbose=0)
+
+
+def export_model_weights(model, path):
+    '''
+    Save weights and activations of trained model built of dense layers to
+    .npz file, which can be evaluated without TensorFlow by NumpyClassifier.
+    '''
+    arrays = {}
+    activations = []
+    for i, layer in enumerate(model.layers):
+        arrays['kernel_{}'.format(i)], arrays['bias_{}'.format(i)] = (
+            layer.get_weights())
+        activations.append(layer.get_config()['activation'])
+    np.savez_compressed(path, activations=np.array(activations), **arrays)
+
+
+def untrained_copy(model):
+    '''
+    Get copy of keras model with freshly initialized weights, compiled with
+    the same optimizer settings and loss, or the defaults of
+    grain_classifier_model if model is not compiled.
+    '''
+    copy = keras.models.clone_model(model)
+    optimizer = getattr(model, 'optimizer', None)
+    if optimizer is not None:
+        optimizer = optimizer.__class__.from_config(optimizer.get_config())
+    copy.compile(
+        optimizer=optimizer or 'adam',
+        loss=getattr(model, 'loss', None) or 'sparse_categorical_crossentropy',
+        metrics=['accuracy'])
+    return copy
+
+
+def network_cross_validation(model, X, y, n_splits):
+    '''
+    Compute cross validation fold scores, loss and accuracy, for given keras
+    model. Each fold trains untrained copy of model, model itself is left
+    untouched.
+    '''
+    validation = cross_validate(partial(untrained_copy, model), X, y,
+                                n_splits, max_workers=1)
+    return np.column_stack((validation.loss, validation.accuracy)).tolist()
 
 
 def mean_confusion_matrix(model, X, y, n_splits):
-    '''Compute mean confusion matrix using cross validation with n splits.'''
+    '''
+    Compute mean confusion matrix using cross validation with n splits,
+    training untrained copy of model on each fold.
+    '''
+    validation = cross_validate(partial(untrained_copy, model), X, y,
+                                n_splits, max_workers=1)
+    return validation.conf_matrix
+
+
+def _limit_tf_threads(n_threads):
+    tf.config.threading.set_intra_op_parallelism_threads(n_threads)
+    tf.config.threading.set_inter_op_parallelism_threads(n_threads)
+
+
+def _tf_executor(max_workers, threads_per_worker):
+    # TensorFlow is not fork safe, so workers are started fresh
+    return ProcessPoolExecutor(max_workers=max_workers,
+                               mp_context=get_context('spawn'),
+                               initializer=_limit_tf_threads,
+                               initargs=(threads_per_worker,))
+
+
+def _train_fold(build_model, X, y, train_index, test_index, epochs,
+                full_batch=False, patience=None):
+    '''Train fresh model on one fold, get its test score and predictions.'''
+    x_train, x_test = X[train_index], X[test_index]
+    y_train, y_test = y[train_index], y[test_index]
+
+    model = build_model()
+    fit_model(model, x_train, y_train, epochs, full_batch, patience)
+    score = model.evaluate(x_test, y_test, verbose=0)
+    y_pred = np.argmax(model.predict(x_test, verbose=0), axis=-1)
+    return score, y_pred
+
+
+def _collect_folds(y, folds, results):
+    '''Gather scores and predictions of trained folds into one result.'''
+    eval_scores = np.array([score for score, _ in results])
+    test_indices = [test_index for _, test_index in folds]
+    predictions = [np.asarray(y_pred) for _, y_pred in results]
+
     conf_matrix = np.zeros((4, 4))
+    for test_index, y_pred in zip(test_indices, predictions):
+        np.add.at(conf_matrix, (y[test_index], y_pred), 1)
+
+    return CrossValidationResult(
+        loss=eval_scores[:, 0],
+        accuracy=eval_scores[:, 1],
+        test_indices=test_indices,
+        predictions=predictions,
+        conf_matrix=conf_matrix / len(folds))
+
+
+def cross_validate(build_model, X, y, n_splits, epochs=300, full_batch=False,
+                   patience=None, max_workers=None, threads_per_worker=1):
+    '''
+    Cross validate models training each fold only once and get test loss and
+    accuracy of each fold, test indices and predictions of each fold and mean
+    confusion matrix. Each fold trains fresh compiled model returned by
+    build_model, which must be picklable, e.g. module level function or
+    partial. Folds are trained concurrently in max_workers processes using
+    threads_per_worker TensorFlow threads each, or in current process if
+    max_workers is 1. Training options are described in fit_model.
+    '''
+    folds = list(StratifiedKFold(n_splits=n_splits).split(X, y))
+    train_fold = partial(_train_fold, build_model, X, y, epochs=epochs,
+                         full_batch=full_batch, patience=patience)
+
+    if max_workers == 1:
+        results = [train_fold(train_index, test_index)
+                   for train_index, test_index in folds]
+    else:
+        with _tf_executor(max_workers, threads_per_worker) as executor:
+            results = list(executor.map(train_fold, *zip(*folds)))
+
+    return _collect_folds(y, folds, results)
+
+
+def parameter_grid(**params_values):
+    '''
+    Get list of all combinations of given grain_classifier_model parameters,
+    e.g. parameter_grid(activation=('relu', 'tanh'), optimizer=('sgd',)).
+    '''
+    names = sorted(params_values)
+    return [dict(zip(names, values))
+            for values in product(*(params_values[name] for name in names))]
+
+
+def _source_digest():
+    '''Get hash of source of this module, which defines trained models.'''
+    with open(__file__, 'rb') as source:
+        return hashlib.sha1(source.read()).hexdigest()
+
+
+def sweep_cross_validation(configs, X, y, n_splits, epochs=300,
+                           full_batch=False, patience=None,
+                           checkpoint_path=None, max_workers=None,
+                           threads_per_worker=1):
+    '''
+    Cross validate grain_classifier_model built with each of given configs,
+    dicts of its parameters, and get list of results in configs order.
+    Folds of all configs are scheduled together over one process pool.
+    Each finished fold is appended to checkpoint_path file if given, so that
+    interrupted sweep run again with the same data resumes where it stopped.
+    Folds are keyed also by source of this module, so checkpoint is not
+    reused after models or training are changed.
+    '''
+    folds = list(StratifiedKFold(n_splits=n_splits).split(X, y))
+    data_digest = hashlib.sha1(np.ascontiguousarray(X).tobytes())
+    data_digest.update(np.ascontiguousarray(y).tobytes())
+    data_digest.update(
+        repr((X.shape, n_splits, epochs, full_batch, patience)).encode())
+    data_digest.update(_source_digest().encode())
+
+    def task_key(config, fold):
+        return json.dumps([config, fold, data_digest.hexdigest()],
+                          sort_keys=True)
+
+    finished = {}
+    if checkpoint_path is not None and os.path.exists(checkpoint_path):
+        with open(checkpoint_path) as checkpoint:
+            for line in checkpoint:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # Line cut short by interrupted write
+                    continue
+                finished[entry['key']] = (entry['score'], entry['y_pred'])
+
+    tasks = {task_key(config, fold): (config, fold)
+             for config in configs for fold in range(n_splits)}
+    pending = [key for key in tasks if key not in finished]
+
+    if pending:
+        checkpoint = None
+        if checkpoint_path is not None:
+            checkpoint_dir = os.path.dirname(checkpoint_path)
+            if checkpoint_dir:
+                os.makedirs(checkpoint_dir, exist_ok=True)
+            checkpoint = open(checkpoint_path, 'a')
+        try:
+            with _tf_executor(max_workers, threads_per_worker) as executor:
+                futures = {}
+                for key in pending:
+                    config, fold = tasks[key]
+                    train_index, test_index = folds[fold]
+                    build_model = partial(grain_classifier_model, **config)
+                    future = executor.submit(_train_fold, build_model, X, y,
+                                             train_index, test_index, epochs,
+                                             full_batch, patience)
+                    futures[future] = key
+                for future in as_completed(futures):
+                    key = futures[future]
+                    score, y_pred = future.result()
+                    finished[key] = ([float(v) for v in score],
+                                     y_pred.tolist())
+                    if checkpoint is not None:
+                        checkpoint.write(json.dumps({
+                            'key': key,
+                            'score': finished[key][0],
+                            'y_pred': finished[key][1]}) + '\n')
+                        checkpoint.flush()
+        finally:
+            if checkpoint is not None:
+                checkpoint.close()
+
+    return [_collect_folds(y, folds, [finished[task_key(config, fold)]
+                                      for fold in range(n_splits)])
+            for config in configs]
+
+
+def main():
+    '''Compare wall time of training setups on default set ratio features.'''
+    # Imported here, so that importing model does not require image stack
+    from blob_series_tracker import count_blobs_with_all_methods_parallel
+    from img_processing import default_img_set_paths
 
-    folds = StratifiedKFold(n_splits=n_splits).split(X, y)
-    for train_index, test_index in folds:
-        x_train, x_test = X[train_index], X[test_index]
-        y_train, y_test = y[train_index], y[test_index]
+    paths, y = default_img_set_paths()
+    X = count_blobs_with_all_methods_parallel(paths)[2]
+    y = np.array(y)
 
-        model.fit(x_train, y_train, epochs=300, verbose=0)
-        y_pred = model.predict_classes(x_test)
+    setups = (
+        ('fixed 300 epochs, float64', {}, {}),
+        ('full batch', {}, {'full_batch': True}),
+        ('early stopping', {}, {'patience': 20}),
+        ('float32', {'dtype': 'float32'}, {}),
+        ('full batch, early stopping, float32', {'dtype': 'float32'},
+         {'full_batch': True, 'patience': 20}),
+    )
+    for name, model_params, fit_params in setups:
+        build_model = partial(grain_classifier_model, **model_params)
+        start = time.perf_counter()
+        validation = cross_validate(build_model, X, y, 3, max_workers=1,
+                                    **fit_params)
+        duration = time.perf_counter() - start
+        print('{}: {:.1f} s, loss {:.2f}, accuracy {:.2f}'.format(
+            name, duration, validation.loss.mean(),
+            validation.accuracy.mean()))
 
-        for test, pred in zip(y_test, y_pred):
-            conf_matrix[test][pred] = conf_matrix[test][pred] + 1
 
-    return conf_matrix / n_splits
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,53 @@
+'''Lightweight NumPy inference for trained grain classifier.'''
+
+import numpy as np
+
+
+def _softmax(x):
+    exp = np.exp(x - x.max(axis=-1, keepdims=True))
+    return exp / exp.sum(axis=-1, keepdims=True)
+
+
+ACTIVATIONS = {
+    'linear': lambda x: x,
+    'tanh': np.tanh,
+    'relu': lambda x: np.maximum(x, 0),
+    'sigmoid': lambda x: 0.5 * (np.tanh(x / 2) + 1),
+    'elu': lambda x: np.where(x > 0, x, np.expm1(np.minimum(x, 0))),
+    'softmax': _softmax,
+}
+
+
+class NumpyClassifier:
+    '''
+    Dense network evaluated with NumPy only, using weights exported from
+    trained keras model with neural_network.export_model_weights.
+    '''
+
+    def __init__(self, kernels, biases, activations):
+        self.kernels = kernels
+        self.biases = biases
+        self.activations = activations
+
+    @classmethod
+    def load(cls, path):
+        '''Load network weights and activations from .npz file.'''
+        with np.load(path) as data:
+            activations = [str(name) for name in data['activations']]
+            kernels = [data['kernel_{}'.format(i)]
+                       for i in range(len(activations))]
+            biases = [data['bias_{}'.format(i)]
+                      for i in range(len(activations))]
+        return cls(kernels, biases, activations)
+
+    def predict(self, X):
+        '''Get class probabilities for batch of samples.'''
+        out = np.asarray(X, dtype=self.kernels[0].dtype)
+        for kernel, bias, activation in zip(self.kernels, self.biases,
+                                            self.activations):
+            out = ACTIVATIONS[activation](out @ kernel + bias)
+        return out
+
+    def predict_classes(self, X):
+        '''Get predicted class for batch of samples.'''
+        return np.argmax(self.predict(X), axis=-1)
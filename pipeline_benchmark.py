@@ -0,0 +1,225 @@
+'''
+Benchmark stages of detection to classification pipeline on default set and
+on synthetic image series of growing frame count, size and blob density.
+'''
+
+import argparse
+from collections import namedtuple
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+from blob_finder import find_blobs
+from blob_series_tracker import (count_blobs_in_series, detect_blob_series,
+                                 stack_counts, track_remaining_blobs)
+from img_processing import (default_img_set_paths, fast_prepare,
+                            full_prepare, load_img_series)
+from numpy_network import NumpyClassifier
+from synthetic_dataset import DEFAULT_SHAPE, write_synthetic_series
+
+BenchmarkResult = namedtuple('BenchmarkResult',
+                             ['stage', 'params', 'seconds', 'peak_bytes'])
+
+
+def measure(func, repeat=3):
+    '''
+    Get best wall time of repeat calls of func and peak memory allocated
+    during one more call, traced separately not to slow down timed calls.
+    '''
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    try:
+        func()
+        _, peak_bytes = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return min(times), peak_bytes
+
+
+def default_classifier(n_frames=5, seed=0):
+    '''
+    Get NumpyClassifier with architecture of default grain classifier and
+    random weights, inference cost does not depend on trained values.
+    '''
+    rng = np.random.RandomState(seed)
+    sizes = (n_frames, 5, 256, 128, 4)
+    kernels = [rng.standard_normal((n_in, n_out)) / np.sqrt(n_in)
+               for n_in, n_out in zip(sizes[:-1], sizes[1:])]
+    biases = [np.zeros(n_out) for n_out in sizes[1:]]
+    return NumpyClassifier(kernels, biases, ['tanh'] * 3 + ['softmax'])
+
+
+def benchmark_default_set(repeat=3):
+    '''Benchmark each pipeline stage on default set images.'''
+    paths, _ = default_img_set_paths()
+    X = [load_img_series(path) for path in paths]
+    X_prep = [[fast_prepare(img) for img in img_series] for img_series in X]
+    blobs = [detect_blob_series(img_series) for img_series in X_prep]
+    Xp = stack_counts([count_blobs_in_series(series) for series in blobs])[2]
+    classifier = default_classifier(Xp.shape[1])
+    params = {'samples': len(X), 'frames': sum(map(len, X))}
+
+    stages = (
+        ('load_img_series', lambda: [load_img_series(path)
+                                     for path in paths]),
+        ('full_prepare', lambda: [[full_prepare(img) for img in img_series]
+                                  for img_series in X]),
+        ('fast_prepare', lambda: [fast_prepare(np.stack(img_series))
+                                  for img_series in X]),
+        ('find_blobs skimage_dog', lambda: [
+            [find_blobs(img) for img in img_series]
+            for img_series in X_prep]),
+        ('find_blobs fast_dog', lambda: [
+            [find_blobs(img, detector='fast_dog') for img in img_series]
+            for img_series in X_prep]),
+        ('track_remaining_blobs', lambda: [track_remaining_blobs(series)
+                                           for series in blobs]),
+        ('count_blobs', lambda: stack_counts(
+            [count_blobs_in_series(series) for series in blobs])),
+        ('classify', lambda: classifier.predict_classes(Xp)),
+    )
+    return [BenchmarkResult(stage, params, *measure(func, repeat))
+            for stage, func in stages]
+
+
+def benchmark_scaling(frames=(5, 20, 80), scales=(1, 2, 4),
+                      densities=(0.25, 1, 4), repeat=3):
+    '''
+    Benchmark loading, preparation, blob detection and tracking of synthetic
+    E5R series written as JPEG images, varying one of frame count, image
+    size scale and blob density at a time. Blob count grows with image area.
+    '''
+    configs = ([{'frames': n, 'scale': 1, 'density': 1} for n in frames] +
+               [{'frames': 5, 'scale': scale, 'density': 1}
+                for scale in scales] +
+               [{'frames': 5, 'scale': 1, 'density': density}
+                for density in densities])
+    results = []
+    seen = set()
+    for params in configs:
+        key = tuple(sorted(params.items()))
+        if key in seen:
+            continue
+        seen.add(key)
+        shape = tuple(size * params['scale'] for size in DEFAULT_SHAPE)
+
+        with tempfile.TemporaryDirectory() as img_dir:
+            path = write_synthetic_series(img_dir, 1, 'E5R',
+                                          params['frames'], shape,
+                                          params['density'])
+            imgs = load_img_series(path)
+            imgs_prep = fast_prepare(np.stack(imgs))
+            blobs = detect_blob_series(imgs_prep, detector='fast_dog')
+
+            stages = (
+                ('synthetic load_img_series', lambda: load_img_series(path)),
+                ('synthetic fast_prepare',
+                 lambda: fast_prepare(np.stack(imgs))),
+                ('synthetic find_blobs skimage_dog',
+                 lambda: detect_blob_series(imgs_prep)),
+                ('synthetic find_blobs fast_dog',
+                 lambda: detect_blob_series(imgs_prep, detector='fast_dog')),
+                ('synthetic track_remaining_blobs',
+                 lambda: track_remaining_blobs(blobs)),
+            )
+            results += [BenchmarkResult(stage, params, *measure(func, repeat))
+                        for stage, func in stages]
+    return results
+
+
+def result_key(result):
+    '''Get key identifying stage and parameters of result in baseline.'''
+    params = ','.join('{}={}'.format(name, value)
+                      for name, value in sorted(result.params.items()))
+    return '{} [{}]'.format(result.stage, params)
+
+
+def save_results(results, path):
+    '''Save results to JSON file, e.g. as baseline.'''
+    results_dir = os.path.dirname(path)
+    if results_dir:
+        os.makedirs(results_dir, exist_ok=True)
+    with open(path, 'w') as results_file:
+        json.dump({result_key(result): result._asdict()
+                   for result in results}, results_file, indent=2)
+
+
+def find_regressions(results, baseline, tolerance=0.25):
+    '''
+    Get keys of results slower or using more memory than baseline results
+    by more than tolerance fraction.
+    '''
+    regressions = []
+    for result in results:
+        base = baseline.get(result_key(result))
+        if base is None:
+            continue
+        if (result.seconds > base['seconds'] * (1 + tolerance) or
+                result.peak_bytes > base['peak_bytes'] * (1 + tolerance)):
+            regressions.append(result_key(result))
+    return regressions
+
+
+def print_results(results, baseline=None):
+    '''Print time, peak memory and change against baseline of results.'''
+    for result in results:
+        line = '{:<66} {:>10.2f} ms {:>9.1f} MB'.format(
+            result_key(result), result.seconds * 1e3,
+            result.peak_bytes / 2**20)
+        base = (baseline or {}).get(result_key(result))
+        if base is not None:
+            line += ' {:>+7.0%}'.format(result.seconds / base['seconds'] - 1)
+        print(line)
+
+
+def main():
+    '''Run benchmarks and compare them with stored baseline.'''
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument('--baseline', default='.benchmarks/baseline.json',
+                        help='baseline results file')
+    parser.add_argument('--save-baseline', action='store_true',
+                        help='store results as new baseline')
+    parser.add_argument('--output', help='save results to JSON file')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='allowed slowdown fraction before regression')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='number of timed runs, best one is reported')
+    parser.add_argument('--quick', action='store_true',
+                        help='skip the largest synthetic series')
+    args = parser.parse_args()
+
+    results = benchmark_default_set(args.repeat)
+    if args.quick:
+        results += benchmark_scaling((5, 20), (1, 2), (0.25, 1), args.repeat)
+    else:
+        results += benchmark_scaling(repeat=args.repeat)
+
+    baseline = None
+    if os.path.exists(args.baseline) and not args.save_baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+    print_results(results, baseline)
+
+    if args.output:
+        save_results(results, args.output)
+    if args.save_baseline:
+        save_results(results, args.baseline)
+    elif baseline is not None:
+        regressions = find_regressions(results, baseline, args.tolerance)
+        if regressions:
+            sys.exit('Regressions against baseline:\n' +
+                     '\n'.join(regressions))
+
+
+if __name__ == '__main__':
+    main()
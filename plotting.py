@@ -0,0 +1,144 @@
+'''Plotting helpers for images, detected blobs and blob counts.'''
+
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.collections import EllipseCollection
+from matplotlib.figure import Figure
+import matplotlib.pyplot as plt
+import matplotlib.patches as mpatches
+import numpy as np
+from skimage.exposure import histogram
+
+from overlay_renderer import run_windowed
+
+
+def show_with_hist(img, title):
+    '''Plot imgage alongside its histogram.'''
+    plt.figure()
+    plt.subplot(121)
+    plt.imshow(img, cmap=plt.get_cmap('gray'))
+    plt.title(title)
+    hist, bins_center = histogram(img)
+    plt.subplot(122)
+    plt.plot(bins_center, hist, lw=2)
+
+
+def use_headless():
+    '''Switch pyplot to non-interactive Agg backend, which only saves files.'''
+    plt.switch_backend('agg')
+
+
+def plot_blobs(ax, blobs, color='r', linewidth=0.75):
+    '''
+    Draw circle around each of given blobs on axes, all circles are drawn
+    as single collection. Get the collection.
+    '''
+    blobs = np.asarray(blobs, dtype=float).reshape(-1, 3)
+    diameters = 2 * blobs[:, 2]
+    circles = EllipseCollection(
+        diameters, diameters, np.zeros(len(blobs)), units='xy',
+        offsets=blobs[:, 1::-1], transOffset=ax.transData,
+        facecolor='none', edgecolor=color, linewidth=linewidth)
+    ax.add_collection(circles)
+    return circles
+
+
+class BlobOverlayFigure:
+    '''
+    Reusable figure rendering image with blobs circled over it to files.
+    Figure is not managed by pyplot and renders with Agg regardless of its
+    backend, image and circles are replaced for each frame, so rendering
+    many frames does not allocate new figures.
+    '''
+
+    def __init__(self, figsize=None, dpi=None, linewidth=0.75):
+        self.fig = Figure(figsize=figsize, dpi=dpi, frameon=False)
+        FigureCanvasAgg(self.fig)
+        self.ax = self.fig.add_axes([0, 0, 1, 1])
+        self.ax.set_axis_off()
+        self.linewidth = linewidth
+        self.image = None
+        self.circles = []
+
+    def render(self, img, stages, colors, path):
+        '''
+        Draw grayscale image with blobs of each stage circled in color
+        of the same index and save it to path.
+        '''
+        height, width = img.shape[:2]
+        if self.image is None:
+            self.image = self.ax.imshow(img, cmap='gray')
+        else:
+            self.image.set_data(img)
+            self.image.autoscale()
+        self.image.set_extent((-0.5, width - 0.5, height - 0.5, -0.5))
+        self.ax.set_autoscale_on(False)
+
+        for circles in self.circles:
+            circles.remove()
+        self.circles = [plot_blobs(self.ax, blobs, color, self.linewidth)
+                        for blobs, color in zip(stages, colors)]
+        self.fig.savefig(path)
+
+
+_overlay_figure = None
+
+
+def _init_overlay_worker(figsize, dpi, linewidth):
+    global _overlay_figure
+    _overlay_figure = BlobOverlayFigure(figsize, dpi, linewidth)
+
+
+def _render_overlay(img, stages, path, colors):
+    _overlay_figure.render(img, stages, colors, path)
+
+
+def render_blob_overlays(frames, colors=('r',), max_workers=None,
+                         figsize=None, dpi=None, linewidth=0.75, window=64):
+    '''
+    Render frames given as iterable of image, its stages of blobs and output
+    path with BlobOverlayFigure, in current process if max_workers is 1 or
+    with run_windowed in max_workers processes, each reusing its own figure.
+    '''
+    if max_workers == 1:
+        overlay_figure = BlobOverlayFigure(figsize, dpi, linewidth)
+        for img, stages, path in frames:
+            overlay_figure.render(img, stages, colors, path)
+        return
+
+    with ProcessPoolExecutor(max_workers=max_workers,
+                             initializer=_init_overlay_worker,
+                             initargs=(figsize, dpi, linewidth)) as executor:
+        run_windowed(executor, partial(_render_overlay, colors=colors),
+                     frames, window)
+
+
+def plot_blob_stat(samples_set, lebels_set, colors):
+    '''Plot blob count versus minutes, one frame is recorded every minute.'''
+    plt.figure()
+    for sample_series, sample_label_index in zip(samples_set, lebels_set):
+        plt.plot(
+            np.arange(len(sample_series)),
+            sample_series,
+            c=colors[sample_label_index],
+            linewidth=1.2)
+
+
+def patch_plot_legend(colors, labels):
+    '''Make given plots share their legend entry.'''
+    legend = [
+        mpatches.Patch(color=color, label=label)
+        for color, label in zip(colors, labels)
+    ]
+    plt.legend(handles=legend)
+
+
+def patch_plot_legend_outside(colors, labels):
+    '''
+    Make given plots share their legend entry and place legend upper right.
+    '''
+    legend = [mpatches.Patch(color=color, label=label)
+              for color, label in zip(colors, labels)]
+    plt.legend(handles=legend, loc='upper right', bbox_to_anchor=(1, 1))
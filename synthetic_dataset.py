@@ -0,0 +1,241 @@
+'''
+Generate synthetic FLIR-like image series of cooling grains for testing
+throughput and memory use of the pipeline at scale.
+'''
+
+import argparse
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+import os
+import time
+
+import numpy as np
+
+from img_processing import (DIGITS_COLS, DIGITS_ROWS, UI_CROP_WIDTH,
+                            encode_labels)
+
+
+# Number of cold spots in first frame, in area of default 240x320 frame
+# after UI crop, fraction of them remaining in each minute of cooling and
+# number of new short lived spots visible in each minute, all following
+# mean blob counts of default set
+GrainClass = namedtuple('GrainClass', ['n_spots', 'remaining', 'transient'])
+
+GRAIN_CLASSES = {
+    'E5R': GrainClass(80, (1, 0.47, 0.29, 0.25, 0.2), (0, 11, 10, 11, 12)),
+    'E6R': GrainClass(65, (1, 0.17, 0.07, 0.02, 0.02), (0, 20, 9, 5, 3)),
+    'E11R': GrainClass(65, (1, 0.06, 0.01, 0, 0), (0, 22, 8, 7, 6)),
+    'E16R': GrainClass(124, (1, 0.06, 0.01, 0.01, 0.01), (0, 33, 14, 10, 8)),
+}
+
+DEFAULT_SHAPE = (240, 320)
+# Sigmas of spots, the same as DoG scales detected in default set
+SPOT_SIGMAS = (1, 1.6, 2.56)
+
+
+def temperature_bounds(shape=DEFAULT_SHAPE):
+    '''
+    Get bounds of temperature values in FLIR UI of frame with given shape,
+    UI is anchored to frame edges, so for default shape these are
+    TEMPERATURE_BOUNDS.
+    '''
+    height, width = shape
+    cols = (width - 37, width - 2)
+    return (((6, 24), cols), ((height - 21, height - 4), cols))
+
+
+def _ui_font(size):
+    from PIL import ImageFont
+
+    try:
+        return ImageFont.truetype('DejaVuSans.ttf', size)
+    except OSError:
+        try:
+            return ImageFont.load_default(size)
+        except TypeError:
+            # Pillow older than 10.1 has only fixed size bitmap font
+            return ImageFont.load_default()
+
+
+def _grains_texture(shape, rng):
+    '''Get bright grains separated by brighter network of gaps.'''
+    from scipy import ndimage as ndi
+
+    coarse = ndi.gaussian_filter(rng.standard_normal(shape), 6)
+    coarse /= coarse.std()
+    fine = ndi.gaussian_filter(rng.standard_normal(shape), 2)
+    fine /= fine.std()
+    gaps = np.exp(-(coarse / 0.25) ** 2)
+    return 0.62 + 0.05 * fine + 0.2 * gaps
+
+
+def _draw_spots(img, rows, cols, sigmas, amplitudes):
+    '''Subtract dark Gaussian spots from image in place.'''
+    height, width = img.shape
+    for row, col, sigma, amplitude in zip(rows, cols, sigmas, amplitudes):
+        # Draw spot only in its neighbourhood
+        r0, r1 = max(int(row - 4 * sigma), 0), min(int(row + 4 * sigma) + 1,
+                                                   height)
+        c0, c1 = max(int(col - 4 * sigma), 0), min(int(col + 4 * sigma) + 1,
+                                                   width)
+        dist2 = ((np.arange(r0, r1)[:, np.newaxis] - row) ** 2 +
+                 (np.arange(c0, c1) - col) ** 2)
+        img[r0:r1, c0:c1] -= amplitude * np.exp(-dist2 / (2 * sigma ** 2))
+
+
+def _draw_ui(rgb, temps, font):
+    '''
+    Draw FLIR UI over frame, unit, maximum and minimum temperature with
+    digits in the same cells as in camera UI, color scale bar and logo.
+    '''
+    from PIL import Image, ImageDraw
+
+    height, width = rgb.shape[:2]
+    img = Image.fromarray(rgb)
+    draw = ImageDraw.Draw(img)
+
+    def text(position, txt):
+        draw.text(position, txt, fill=(255, 255, 255), font=font,
+                  stroke_width=1, stroke_fill=(0, 0, 0))
+
+    text((3, 4), '°C')
+    text((3, height - 20), 'FLIR')
+    for bound, temp in zip(temperature_bounds((height, width)), temps):
+        (top, _), (left, _) = bound
+        digits = '{:04.1f}'.format(temp).replace('.', '')
+        for cols, digit in zip(DIGITS_COLS, digits):
+            text((left + cols[0], top + DIGITS_ROWS[0] - 3), digit)
+        text((left + DIGITS_COLS[1][1], top + DIGITS_ROWS[0] - 3), ',')
+
+    # Color scale from hottest on top to coldest at the bottom
+    top, bottom = 30, height - 25
+    scale = np.linspace(255, 0, bottom - top).astype(np.uint8)
+    bar = np.repeat(scale[:, np.newaxis, np.newaxis], 3, axis=2)
+    rgb = np.array(img)
+    rgb[top:bottom, width - 22:width - 14] = bar
+    return rgb
+
+
+def synthetic_series(grain_class, n_frames=5, shape=DEFAULT_SHAPE,
+                     density=1, seed=0):
+    '''
+    Yield RGB uint8 frames of single grain sample cooling down. Frames are
+    equally spaced over the same 4 minutes as default set regardless of
+    n_frames. Spots fade following remaining fraction of grain class, with
+    count scaled by density and area of frame.
+    '''
+    params = GRAIN_CLASSES[grain_class]
+    rng = np.random.RandomState(seed)
+    (top, bottom), (left, right) = UI_CROP_WIDTH
+    default_area = ((DEFAULT_SHAPE[0] - top - bottom) *
+                    (DEFAULT_SHAPE[1] - left - right))
+    area = (shape[0] - top - bottom) * (shape[1] - left - right)
+    area_scale = density * area / default_area
+
+    def random_spots(n_spots):
+        rows = rng.uniform(top, shape[0] - bottom, n_spots)
+        cols = rng.uniform(left, shape[1] - right, n_spots)
+        sigmas = rng.choice(SPOT_SIGMAS, n_spots)
+        amplitudes = rng.uniform(0.35, 0.6, n_spots)
+        return rows, cols, sigmas, amplitudes
+
+    # Spot is still visible while its random level is below remaining
+    # fraction, which decreases over time
+    n_spots = int(round(params.n_spots * area_scale))
+    rows, cols, sigmas, amplitudes = random_spots(n_spots)
+    levels = rng.uniform(0, 1, n_spots)
+    minutes = np.linspace(0, len(params.remaining) - 1, n_frames)
+    remaining = np.interp(minutes, np.arange(len(params.remaining)),
+                          params.remaining)
+    n_transient = np.round(area_scale * np.interp(
+        minutes, np.arange(len(params.transient)), params.transient))
+
+    texture = _grains_texture(shape, rng)
+    font = _ui_font(16)
+    for frame, minute in enumerate(minutes):
+        img = texture + 0.015 * rng.standard_normal(shape)
+        # Tracked spots move slightly between frames
+        jitter = rng.normal(0, 0.3, n_spots)
+        visible = levels < remaining[frame]
+        _draw_spots(img, rows[visible] + jitter[visible], cols[visible],
+                    sigmas[visible], amplitudes[visible])
+        _draw_spots(img, *random_spots(int(n_transient[frame])))
+
+        gray = (np.clip(img, 0, 1) * 255).astype(np.uint8)
+        rgb = np.repeat(gray[..., np.newaxis], 3, axis=2)
+        temp_max = 25 + 28 * np.exp(-minute / 6)
+        temp_min = temp_max - 5 * np.exp(-minute / 12)
+        yield _draw_ui(rgb, (temp_max, temp_min), font)
+
+
+def write_synthetic_series(out_dir, sample_id, grain_class, n_frames=5,
+                           shape=DEFAULT_SHAPE, density=1, seed=0,
+                           quality=90):
+    '''
+    Write synthetic series as NNN_CLASS_i.jpg images into out_dir and get
+    path of series the way default_img_set_paths gives them.
+    '''
+    from PIL import Image
+
+    series_path = os.path.join(out_dir, '{:03d}_{}'.format(sample_id,
+                                                           grain_class))
+    frames = synthetic_series(grain_class, n_frames, shape, density, seed)
+    for i, rgb in enumerate(frames):
+        Image.fromarray(rgb).save('{}_{}.jpg'.format(series_path, i),
+                                  quality=quality)
+    return series_path
+
+
+def _write_indexed_series(out_dir, n_frames, shape, density, seed, sample):
+    sample_id, grain_class = sample
+    return write_synthetic_series(out_dir, sample_id, grain_class, n_frames,
+                                  shape, density, seed + sample_id)
+
+
+def generate_dataset(out_dir, n_series_per_class=3, n_frames=5,
+                     shape=DEFAULT_SHAPE, density=1, seed=0,
+                     max_workers=None):
+    '''
+    Write synthetic data set with n_series_per_class of each grain class
+    into out_dir, each series is generated in separate process. Get paths
+    of series and their labels the same way as default_img_set_paths.
+    '''
+    os.makedirs(out_dir, exist_ok=True)
+    labels = [grain_class for _ in range(n_series_per_class)
+              for grain_class in GRAIN_CLASSES]
+    samples = list(enumerate(labels, 1))
+    write_series = partial(_write_indexed_series, out_dir, n_frames, shape,
+                           density, seed)
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        paths = list(executor.map(write_series, samples))
+    return [paths, encode_labels(labels)]
+
+
+def main():
+    '''Generate synthetic data set of grain image series.'''
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument('out_dir', help='directory to write images into')
+    parser.add_argument('-n', '--series-per-class', type=int, default=3)
+    parser.add_argument('-f', '--frames', type=int, default=5)
+    parser.add_argument('--height', type=int, default=DEFAULT_SHAPE[0])
+    parser.add_argument('--width', type=int, default=DEFAULT_SHAPE[1])
+    parser.add_argument('--density', type=float, default=1,
+                        help='multiplier of number of spots per area')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+                        help='number of parallel processes')
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    paths, _ = generate_dataset(args.out_dir, args.series_per_class,
+                                args.frames, (args.height, args.width),
+                                args.density, args.seed, args.jobs)
+    duration = time.perf_counter() - start
+    n_images = len(paths) * args.frames
+    print('{} series, {} images in {:.1f} s'.format(len(paths), n_images,
+                                                    duration))
+
+
+if __name__ == '__main__':
+    main()
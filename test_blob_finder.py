@@ -0,0 +1,138 @@
+'''Tests of blob detectors and on-disk cache of detected blobs.'''
+
+import glob
+import os
+
+import numpy as np
+import pytest
+
+import blob_finder
+from blob_finder import (BlobCache, fast_dog_detector, find_blobs,
+                         skimage_dog_detector)
+from img_processing import fast_prepare, iter_img_series
+from synthetic_dataset import synthetic_series
+
+
+IMG_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'img')
+IMG_SERIES = sorted({path.rsplit('_', 1)[0]
+                     for path in glob.glob(os.path.join(IMG_DIR, '*.jpg'))})
+
+
+def assert_same_blobs(blobs, expected):
+    assert blobs.dtype == expected.dtype
+    np.testing.assert_array_equal(blobs, expected)
+
+
+@pytest.mark.parametrize('path', IMG_SERIES,
+                         ids=[os.path.basename(p) for p in IMG_SERIES])
+def test_matches_skimage_on_img_series(path):
+    for img in iter_img_series(path, fast_prepare):
+        assert_same_blobs(find_blobs(img, detector='fast_dog'),
+                          find_blobs(img, detector='skimage_dog'))
+
+
+@pytest.mark.parametrize('dtype', [np.float64, np.float32])
+@pytest.mark.parametrize('max_sigma, threshold',
+                         [(2, 0.1), (5, 0.02), (10, 0.05)])
+def test_matches_skimage_on_dense_frames(max_sigma, threshold, dtype):
+    # Many overlapping blobs, where order of pruning decides which remain
+    for seed in range(5):
+        for rgb in synthetic_series('E16R', 2, density=8, seed=seed):
+            img = fast_prepare(rgb, dtype)
+            assert_same_blobs(fast_dog_detector(img, max_sigma, threshold),
+                              skimage_dog_detector(img, max_sigma, threshold))
+
+
+def test_no_blobs():
+    for img in (np.zeros((40, 50)), np.full((40, 50), 0.5)):
+        assert fast_dog_detector(img, 2, 0.1).shape == (0, 3)
+        assert skimage_dog_detector(img, 2, 0.1).shape == (0, 3)
+
+
+def cache_files(cache_dir):
+    return sorted(os.listdir(cache_dir))
+
+
+def cache_size(cache_dir):
+    return sum(entry.stat().st_size for entry in os.scandir(cache_dir))
+
+
+def test_cache_miss_and_hit(tmp_path):
+    cache = BlobCache(str(tmp_path))
+    img = np.random.RandomState(0).uniform(0, 1, (40, 50))
+    key = cache.key(img, max_sigma=2)
+    assert cache.get(key) is None
+
+    blobs = np.array([[1, 2, 1.5], [10, 20, 2.5]])
+    cache.put(key, blobs)
+    np.testing.assert_array_equal(cache.get(key), blobs)
+    assert cache.key(img, max_sigma=3) != key
+    assert cache.key(img + 1e-9, max_sigma=2) != key
+
+
+def test_find_blobs_cache_keyed_by_skimage_version(tmp_path, monkeypatch):
+    cache = BlobCache(str(tmp_path))
+    img = fast_prepare(next(iter_img_series(IMG_SERIES[0])))
+    blobs = find_blobs(img, cache=cache)
+    np.testing.assert_array_equal(find_blobs(img, cache=cache), blobs)
+    assert len(cache_files(tmp_path)) == 1
+
+    # Entries detected with other skimage version are not reused
+    monkeypatch.setattr(blob_finder, '_skimage_version_str', lambda: '0.15.0')
+    find_blobs(img, cache=cache)
+    assert len(cache_files(tmp_path)) == 2
+
+
+def test_cache_put_is_atomic(tmp_path, monkeypatch):
+    cache = BlobCache(str(tmp_path))
+    blobs = np.array([[1, 2, 1.5]])
+    cache.put('key', blobs)
+
+    def failing_save(file, arr):
+        file.write(b'partial')
+        raise OSError('disk full')
+
+    # Failed write leaves previous entry intact
+    monkeypatch.setattr(np, 'save', failing_save)
+    with pytest.raises(OSError):
+        cache.put('key', np.zeros((5, 3)))
+    monkeypatch.undo()
+    np.testing.assert_array_equal(cache.get('key'), blobs)
+    assert cache_files(tmp_path) == ['key.npy']
+
+
+def test_cache_evicts_least_recently_used(tmp_path):
+    entry_blobs = np.zeros((10, 3))
+    entry_size = 128 + entry_blobs.nbytes
+    cache = BlobCache(str(tmp_path), max_bytes=10 * entry_size,
+                      low_water=0.5)
+    for i in range(10):
+        cache.put(str(i), entry_blobs)
+        os.utime(os.path.join(str(tmp_path), '{}.npy'.format(i)), (i, i))
+    assert cache._size == cache_size(tmp_path) == 10 * entry_size
+
+    # Reading entry marks it as recently used
+    assert cache.get('0') is not None
+    cache.put('10', entry_blobs)
+    assert cache_files(tmp_path) == sorted(
+        '{}.npy'.format(i) for i in (0, 7, 8, 9, 10))
+    assert cache._size == cache_size(tmp_path) == 5 * entry_size
+
+
+def test_cache_size_bookkeeping(tmp_path):
+    cache = BlobCache(str(tmp_path))
+    cache.put('a', np.zeros((10, 3)))
+    cache.put('b', np.zeros((20, 3)))
+    assert cache._size == cache_size(tmp_path)
+    # Replaced entry is not counted twice
+    cache.put('a', np.zeros((2, 3)))
+    assert cache._size == cache_size(tmp_path)
+
+    # Other cache on the same directory starts from its actual size
+    other = BlobCache(str(tmp_path))
+    other.put('c', np.zeros((1, 3)))
+    assert other._size == cache_size(tmp_path)
+
+    cache.clear()
+    assert cache._size == 0
+    assert cache_files(tmp_path) == []
@@ -0,0 +1,166 @@
+'''Tests of blob tracking, regression against original double loop.'''
+
+import glob
+import os
+
+import numpy as np
+import pytest
+
+from blob_series_tracker import (BlobTracker, count_blobs_in_series,
+                                 detect_img_series, find_remaining_blobs,
+                                 inside_circle, resample_series, stack_counts)
+from img_processing import fast_prepare, replay_img_series
+
+
+IMG_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'img')
+IMG_SERIES = sorted({path.rsplit('_', 1)[0]
+                     for path in glob.glob(os.path.join(IMG_DIR, '*.jpg'))})
+
+
+def unique(multilist):
+    '''Get list without repeating values.'''
+    return list(set(tuple(i) for i in multilist))
+
+
+def find_remaining_blobs_loop(new_blobs, old_blobs):
+    '''Original double loop implementation of find_remaining_blobs.'''
+    remaining = []
+    for new_blob in new_blobs:
+        yn, xn, _ = new_blob
+        for old_blob in old_blobs:
+            yo, xo, ro = old_blob
+            if inside_circle(xn, yn, xo, yo, 2 * ro):
+                remaining.append(new_blob)
+    return unique(remaining)
+
+
+def as_blob_set(blobs):
+    return set(map(tuple, np.asarray(blobs, dtype=float).reshape(-1, 3)))
+
+
+def random_blobs(rng, n_blobs, shape=(194, 258)):
+    # Integer positions with few radiuses like detected blobs, so blobs
+    # often lie exactly on proximity circles of each other
+    return np.column_stack((rng.randint(0, shape[0], n_blobs),
+                            rng.randint(0, shape[1], n_blobs),
+                            rng.choice((1, 1.6, 2.56), n_blobs)))
+
+
+@pytest.mark.parametrize('seed', range(100))
+def test_matches_loop_on_random_frames(seed):
+    rng = np.random.RandomState(seed)
+    new_blobs = random_blobs(rng, rng.randint(0, 300))
+    old_blobs = random_blobs(rng, rng.randint(0, 300))
+    remaining = find_remaining_blobs(new_blobs, old_blobs)
+    expected = find_remaining_blobs_loop(new_blobs, old_blobs)
+    assert len(remaining) == len(expected)
+    assert as_blob_set(remaining) == as_blob_set(expected)
+
+
+@pytest.mark.parametrize('path', IMG_SERIES,
+                         ids=[os.path.basename(p) for p in IMG_SERIES])
+def test_matches_loop_on_img_series(path):
+    remaining = expected = None
+    for new_blobs in detect_img_series(path):
+        if remaining is None:
+            remaining = expected = new_blobs
+            continue
+        remaining = find_remaining_blobs(new_blobs, remaining)
+        expected = find_remaining_blobs_loop(new_blobs, expected)
+        assert as_blob_set(remaining) == as_blob_set(expected)
+
+
+@pytest.mark.parametrize('new_blobs, old_blobs', [
+    ([], []),
+    ([], [[1, 1, 1]]),
+    ([[1, 1, 1]], []),
+    (np.zeros((0, 3)), np.zeros((0, 3))),
+])
+def test_empty_input(new_blobs, old_blobs):
+    remaining = find_remaining_blobs(new_blobs, old_blobs)
+    assert remaining.shape == (0, 3)
+    assert find_remaining_blobs_loop(new_blobs, old_blobs) == []
+
+
+def tracker_counts(blobs_series):
+    tracker = BlobTracker()
+    for blobs in blobs_series:
+        tracker.update_blobs(blobs)
+    return tracker.counts_all, tracker.counts_rem, tracker.ratios_rem
+
+
+def test_empty_first_frame():
+    series = [np.zeros((0, 3)), np.array([[10, 10, 1]])]
+    count_all, count_rem, ratio_rem = count_blobs_in_series(series)
+    assert list(count_all) == [0, 1]
+    assert list(count_rem) == [0, 0]
+    assert list(ratio_rem) == [0, 0]
+    assert tracker_counts(series) == ([0, 1], [0, 0], [0, 0])
+
+
+def test_tracker_counts():
+    blobs = [[10, 10, 1], [50, 50, 1.6]]
+    series = [np.array(blobs), np.array(blobs[:1]), np.zeros((0, 3))]
+    assert tracker_counts(series) == ([2, 1, 0], [2, 1, 0], [1, 0.5, 0])
+
+
+@pytest.mark.parametrize('path', IMG_SERIES,
+                         ids=[os.path.basename(p) for p in IMG_SERIES])
+def test_tracker_on_replayed_img_series(path):
+    tracker = BlobTracker()
+    for img in replay_img_series(path, fast_prepare, fps=30):
+        tracker.update(img)
+    count_all, count_rem, ratio_rem = count_blobs_in_series(
+        detect_img_series(path))
+    assert tracker.counts_all == list(count_all)
+    assert tracker.counts_rem == list(count_rem)
+    np.testing.assert_array_equal(tracker.ratios_rem, ratio_rem)
+
+
+def test_resample_same_length():
+    values = np.array([[5, 3, 2, 2, 1], [0, 4, 1, 0, 7]])
+    np.testing.assert_array_equal(resample_series(values, 5), values)
+
+
+def test_resample_upsampling():
+    np.testing.assert_allclose(resample_series([4, 2, 0], 5),
+                               [4, 3, 2, 1, 0])
+    # Single frame is held over all frames
+    np.testing.assert_array_equal(resample_series([3], 4), [3, 3, 3, 3])
+
+
+def test_resample_downsampling():
+    np.testing.assert_allclose(resample_series(np.arange(9), 5),
+                               [0, 2, 4, 6, 8])
+    np.testing.assert_allclose(resample_series(np.arange(7), 3), [0, 3, 6])
+    np.testing.assert_allclose(resample_series(np.arange(4), 3),
+                               [0, 1.5, 3])
+
+
+def test_stack_counts():
+    counts = [([4, 3, 2], [4, 2, 1], [1, 0.5, 0.25]),
+              ([6, 4, 2], [2, 2, 0], [1, 1, 0])]
+    Xa, Xr, Xp = stack_counts(counts)
+    np.testing.assert_array_equal(Xa, [[4, 3, 2], [6, 4, 2]])
+    np.testing.assert_array_equal(Xr, [[4, 2, 1], [2, 2, 0]])
+    np.testing.assert_array_equal(Xp, [[1, 0.5, 0.25], [1, 1, 0]])
+    # Resampling series to their own length keeps them
+    for X, expected in zip(stack_counts(counts, n_frames=3), (Xa, Xr, Xp)):
+        np.testing.assert_array_equal(X, expected)
+
+
+def test_stack_ragged_counts():
+    # Series of 9, 3 and 1 frames resampled to 5 frames, ratios are
+    # computed from resampled remaining counts
+    counts = [(np.arange(9, 0, -1), np.arange(8, -1, -1), None),
+              ([6, 4, 2], [4, 2, 0], None),
+              ([3], [0], None)]
+    Xa, Xr, Xp = stack_counts(counts, n_frames=5)
+    assert Xa.shape == Xr.shape == Xp.shape == (3, 5)
+    np.testing.assert_allclose(Xa, [[9, 7, 5, 3, 1], [6, 5, 4, 3, 2],
+                                    [3, 3, 3, 3, 3]])
+    np.testing.assert_allclose(Xr, [[8, 6, 4, 2, 0], [4, 3, 2, 1, 0],
+                                    [0, 0, 0, 0, 0]])
+    np.testing.assert_allclose(Xp, [[1, 0.75, 0.5, 0.25, 0],
+                                    [1, 0.75, 0.5, 0.25, 0],
+                                    [0, 0, 0, 0, 0]])
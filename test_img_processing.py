@@ -0,0 +1,214 @@
+'''Tests of image preparation and temperature reading.'''
+
+import csv
+import glob
+import os
+
+import numpy as np
+import pytest
+import pytesseract
+from skimage.color import rgb2gray
+from skimage.io import imread
+
+from blob_finder import find_blobs
+from img_processing import (DIGITS_ROWS, TEMPERATURE_BOUNDS, DigitReader,
+                            content_hash, fast_prepare, full_prepare,
+                            get_temperature_bounds_batch, read_temperatures,
+                            temperature_txt_imgs)
+
+
+IMG_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'img')
+IMG_PATHS = sorted(glob.glob(os.path.join(IMG_DIR, '*.jpg')))
+# Temperature bounds (max, min) shown on FLIR UI of each image, hand labelled
+TEMPERATURE_BOUNDS_CSV = os.path.join(IMG_DIR, 'temperature_bounds.csv')
+
+
+def load_temperature_bounds():
+    with open(TEMPERATURE_BOUNDS_CSV, newline='') as csv_file:
+        return {row['file']: [float(row['max']), float(row['min'])]
+                for row in csv.DictReader(csv_file, delimiter=';')}
+
+
+@pytest.fixture(scope='module')
+def imgs():
+    return [imread(path) for path in IMG_PATHS]
+
+
+@pytest.fixture(scope='module')
+def gray_imgs(imgs):
+    return [rgb2gray(img) for img in imgs]
+
+
+@pytest.fixture(scope='module')
+def temps():
+    bounds = load_temperature_bounds()
+    return [bounds[os.path.basename(path)] for path in IMG_PATHS]
+
+
+def test_fast_prepare_matches_full_prepare(imgs):
+    for img in imgs:
+        expected = full_prepare(img)
+        img_prep = fast_prepare(img)
+        assert img_prep.dtype == np.float64
+        np.testing.assert_allclose(img_prep, expected, rtol=0, atol=1e-15)
+
+        img_prep = fast_prepare(img, np.float32)
+        assert img_prep.dtype == np.float32
+        np.testing.assert_allclose(img_prep, expected, rtol=0, atol=1e-6)
+
+
+def test_fast_prepare_into_out(imgs):
+    out = np.empty(fast_prepare(imgs[0]).shape, dtype=np.float32)
+    for img in imgs:
+        img_prep = fast_prepare(img, np.float32, out=out)
+        assert img_prep is out
+        np.testing.assert_array_equal(out, fast_prepare(img, np.float32))
+
+
+def test_fast_prepare_stack(imgs):
+    stack = np.stack(imgs)
+    imgs_prep = fast_prepare(stack)
+    assert imgs_prep.shape == (len(imgs),) + fast_prepare(imgs[0]).shape
+    for img, img_prep in zip(imgs, imgs_prep):
+        np.testing.assert_array_equal(img_prep, fast_prepare(img))
+
+
+def test_fast_prepare_gives_the_same_blobs(imgs):
+    for img in imgs:
+        np.testing.assert_array_equal(find_blobs(fast_prepare(img)),
+                                      find_blobs(full_prepare(img)))
+
+
+def test_fast_prepare_rejects_grayscale(imgs):
+    with pytest.raises(ValueError):
+        fast_prepare(imgs[0][..., 0])
+
+
+def test_temperature_bounds_labelled():
+    assert sorted(load_temperature_bounds()) == [
+        os.path.basename(path) for path in IMG_PATHS]
+
+
+def test_digit_reader_reads_unseen_images(gray_imgs, temps):
+    # Every digit appears in both halves of labelled images
+    reader = DigitReader.learn(gray_imgs[::2], temps[::2])
+    assert [reader(img) for img in gray_imgs[1::2]] == temps[1::2]
+    reader = DigitReader.learn(gray_imgs[1::2], temps[1::2])
+    assert [reader(img) for img in gray_imgs[::2]] == temps[::2]
+
+
+def test_digit_reader_below_min_score(gray_imgs, temps):
+    reader = DigitReader.learn(gray_imgs, temps)
+    # Blank digits of max value, which then match no template
+    img = gray_imgs[0].copy()
+    (row_start, _), (col_start, col_stop) = TEMPERATURE_BOUNDS[0]
+    img[row_start + DIGITS_ROWS[0]:row_start + DIGITS_ROWS[1],
+        col_start:col_stop] = 0
+    assert reader(img) == [None, temps[0][1]]
+
+    # Digits matching worse than min_score are not read
+    reader.min_score = 1.0
+    assert reader(gray_imgs[0]) == [None, None]
+
+
+class FakeTesseract:
+    '''
+    Stand-in for pytesseract.image_to_string, which reads known text images
+    alone or stacked into page with read_temperatures, recording each call.
+    '''
+
+    def __init__(self, imgs, temps, gap=16):
+        self.gap = gap
+        self.texts = []
+        for img, img_temps in zip(imgs, temps):
+            for img_txt, temp in zip(temperature_txt_imgs(img), img_temps):
+                self.texts.append((img_txt, '{:.0f}'.format(temp * 10)))
+        self.calls = []
+        self.merge_lines = False
+
+    def read_line(self, page, row):
+        for img_txt, text in self.texts:
+            height, width = img_txt.shape
+            line = page[row:row + height, :width]
+            if line.shape == img_txt.shape and (line == img_txt).all():
+                return text, height
+        raise AssertionError('unknown text image')
+
+    def __call__(self, image, config=''):
+        page = np.asarray(image)
+        if '--psm 6' not in config:
+            self.calls.append(1)
+            return self.read_line(page, 0)[0] + '\n'
+        lines = []
+        row = self.gap
+        while row < page.shape[0]:
+            text, height = self.read_line(page[:, self.gap:], row)
+            lines.append(text)
+            row += height + 2 * self.gap
+        self.calls.append(len(lines))
+        if self.merge_lines:
+            lines = [''.join(lines)]
+        return '\n'.join(lines) + '\n\f'
+
+
+@pytest.fixture
+def tesseract(monkeypatch, gray_imgs, temps):
+    fake = FakeTesseract(gray_imgs, temps)
+    monkeypatch.setattr(pytesseract, 'image_to_string', fake)
+    return fake
+
+
+def test_read_temperatures_single_call(tesseract, gray_imgs, temps):
+    txt_imgs = [img_txt for img in gray_imgs[:5]
+                for img_txt in temperature_txt_imgs(img)]
+    expected = [temp for img_temps in temps[:5] for temp in img_temps]
+    assert read_temperatures(txt_imgs) == expected
+    assert tesseract.calls == [10]
+
+
+def test_read_temperatures_fallback(tesseract, gray_imgs, temps):
+    # Lines merged on page are read again one by one
+    tesseract.merge_lines = True
+    txt_imgs = temperature_txt_imgs(gray_imgs[0])
+    assert read_temperatures(txt_imgs) == temps[0]
+    assert tesseract.calls == [2, 1, 1]
+
+
+class PartialReader:
+    '''Reader knowing values of images, except given (image, bound) ones.'''
+
+    def __init__(self, imgs, temps, unread):
+        self.indices = {content_hash(img): i for i, img in enumerate(imgs)}
+        self.temps = temps
+        self.unread = unread
+
+    def __call__(self, img):
+        i = self.indices[content_hash(img)]
+        return [None if (i, j) in self.unread else temp
+                for j, temp in enumerate(self.temps[i])]
+
+
+def test_temperature_bounds_batch(tesseract, gray_imgs, temps):
+    imgs, temps = gray_imgs[:8], temps[:8]
+    keys = [content_hash(img, bounds=TEMPERATURE_BOUNDS) for img in imgs]
+    # Images 0 and 1 are cached, reader misses max of 2, min of 3, both
+    # values of 4 and min of 5, so 5 values are read in batches of 2
+    cache = {keys[0]: temps[0], keys[1]: temps[1]}
+    reader = PartialReader(imgs, temps, {(2, 0), (3, 1), (4, 0), (4, 1),
+                                         (5, 1)})
+    assert get_temperature_bounds_batch(imgs, cache=cache, reader=reader,
+                                        batch_size=2) == temps
+    assert tesseract.calls == [2, 2, 1]
+    assert cache == dict(zip(keys, temps))
+
+    # All values are cached now
+    tesseract.calls.clear()
+    assert get_temperature_bounds_batch(imgs, cache=cache) == temps
+    assert tesseract.calls == []
+
+
+def test_temperature_bounds_batch_without_reader(tesseract, gray_imgs,
+                                                 temps):
+    assert get_temperature_bounds_batch(gray_imgs[:4], batch_size=3) == \
+        temps[:4]
+    assert tesseract.calls == [3, 3, 2]
@@ -0,0 +1,43 @@
+'''Tests of NumPy inference against keras models it was exported from.'''
+
+import numpy as np
+import pytest
+
+from neural_network import (export_model_weights, fit_model,
+                            grain_classifier_model)
+from numpy_network import ACTIVATIONS, NumpyClassifier
+
+
+@pytest.mark.parametrize('dtype, tolerance', [(None, 1e-12),
+                                              ('float32', 1e-6)])
+@pytest.mark.parametrize('activation',
+                         sorted(set(ACTIVATIONS) - {'softmax'}))
+def test_matches_keras(tmp_path, activation, dtype, tolerance):
+    rng = np.random.RandomState(0)
+    X = rng.uniform(0, 1, (24, 5))
+    y = np.repeat(np.arange(4), 6)
+
+    model = grain_classifier_model(activation, (16, 8), dtype=dtype)
+    fit_model(model, X, y, epochs=3)
+    path = str(tmp_path / 'weights.npz')
+    export_model_weights(model, path)
+    classifier = NumpyClassifier.load(path)
+
+    expected = model.predict(X, verbose=0)
+    np.testing.assert_allclose(classifier.predict(X), expected,
+                               rtol=0, atol=tolerance)
+    np.testing.assert_array_equal(classifier.predict_classes(X),
+                                  np.argmax(expected, axis=-1))
+
+
+def test_input_width_follows_n_frames(tmp_path):
+    model = grain_classifier_model(n_frames=9)
+    assert model.input_shape == (None, 9)
+    assert [layer.units for layer in model.layers] == [5, 256, 128, 4]
+
+    path = str(tmp_path / 'weights.npz')
+    export_model_weights(model, path)
+    X = np.random.RandomState(0).uniform(0, 1, (3, 9))
+    np.testing.assert_allclose(NumpyClassifier.load(path).predict(X),
+                               model.predict(X, verbose=0), rtol=0,
+                               atol=1e-12)
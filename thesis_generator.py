@@ -1,7 +1,15 @@
 '''Generate images, plots and tables for bachelor's thesis paper.'''
 
+import argparse
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import csv
+from functools import partial
+import glob
+import json
 import os
+import sys
+import time
 
 import matplotlib.pyplot as plt
 import numpy as np
@@ -10,19 +18,127 @@ from skimage.filters import threshold_otsu
 from skimage.io import imread, imsave
 from skimage.transform import rescale
 from skimage.util import invert, img_as_ubyte
-import tikzplotlib
 from sklearn.model_selection import train_test_split
-from tensorflow import keras
 
-from blob_analysis import (count_blobs_with_all_methods, patch_plot_legend,
-                           plot_blob_stat)
-from blob_detection_compare_demo import compare_detection
-from blob_series_tracker import (find_blob_series,
-                                 ratio_of_remaining_blobs_in_stages)
-from img_processing import (crop_ui, default_img_set, full_prepare,
-                            load_img_series)
-from neural_network import (default_grain_classifier_model,
-                            network_cross_validation, mean_confusion_matrix)
+from blob_finder import BlobCache
+from blob_series_tracker import (count_blobs_in_series, detect_blob_series,
+                                 detect_blob_series_parallel,
+                                 ratio_of_remaining_blobs_in_stages,
+                                 stack_counts, track_remaining_blobs)
+from img_processing import (TEMPERATURE_BOUNDS, crop_ui, default_img_set_paths,
+                            fast_prepare, load_img_series)
+from plotting import (BlobOverlayFigure, patch_plot_legend, plot_blob_stat,
+                      plot_blobs, render_blob_overlays, use_headless)
+
+
+class ExportContext:
+    '''
+    Lazily computed images, detected blobs and blob counts shared by all
+    generators, so that each image is processed only once per export.
+    Classifiers are built with model_params passed to grain_classifier_model
+    and trained with fit_params passed to fit_model. Cross validations train
+    folds in up to tf_workers processes, or one per core if None.
+    '''
+
+    def __init__(self, cache=None, model_params=None, fit_params=None,
+                 tf_workers=None):
+        self.cache = cache
+        self.model_params = model_params or {}
+        self.fit_params = fit_params or {}
+        self.tf_workers = tf_workers
+        self._memo = {}
+
+    def _memoized(self, key, compute):
+        if key not in self._memo:
+            self._memo[key] = compute()
+        return self._memo[key]
+
+    def invalidate(self, name=None):
+        '''Forget values computed for given sample or all values.'''
+        if name is None:
+            self._memo.clear()
+            return
+        stale = [key for key in self._memo
+                 if key[1] == name or key[0] in ('counts', 'validation')]
+        for key in stale:
+            del self._memo[key]
+
+    def values(self):
+        '''Get all computed values, e.g. to share them with workers.'''
+        return dict(self._memo)
+
+    def update(self, values):
+        '''Add values computed by other context.'''
+        self._memo.update(values)
+
+    def imgs(self, name):
+        '''Get images of sample series with given name.'''
+        return self._memoized(('imgs', name),
+                              lambda: load_img_series('img/' + name))
+
+    def imgs_prep(self, name):
+        '''Get images of sample series prepared for processing.'''
+        return self._memoized(
+            ('imgs_prep', name),
+            lambda: [fast_prepare(img) for img in self.imgs(name)])
+
+    def imgs_crop(self, name):
+        '''Get images of sample series prepared for displaying.'''
+        return self._memoized(
+            ('imgs_crop', name),
+            lambda: [crop_ui(rgb2gray(img)) for img in self.imgs(name)])
+
+    def blob_series(self, name):
+        '''Get blobs detected in each image of sample series.'''
+        return self._memoized(
+            ('blobs', name),
+            lambda: detect_blob_series(self.imgs_prep(name), self.cache))
+
+    def blob_counts(self):
+        '''
+        Get number of blobs in default set using three ways of counting
+        and labels of its samples.
+        '''
+        return self._memoized(('counts', None), self._count_default_set)
+
+    def _count_default_set(self):
+        paths, y = default_img_set_paths()
+        names = [os.path.basename(path) for path in paths]
+
+        # Detect blobs in series that were not processed yet in parallel
+        missing = [name for name in names if ('blobs', name) not in self._memo]
+        blobs = detect_blob_series_parallel(
+            ['img/' + name for name in missing], cache=self.cache)
+        for name, blob_series in zip(missing, blobs):
+            self._memo[('blobs', name)] = blob_series
+
+        counts = [count_blobs_in_series(self.blob_series(name))
+                  for name in names]
+        Xs = stack_counts(counts)
+        return Xs, y
+
+    def cross_validation(self, method):
+        '''
+        Get 3 fold cross validation of default classifier trained on blob
+        counts of default set obtained with given counting method index.
+        '''
+        def validate():
+            # TensorFlow is slow to import, so it is imported only where
+            # needed
+            from neural_network import cross_validate, grain_classifier_model
+
+            Xs, y = self.blob_counts()
+            build_model = partial(grain_classifier_model, **self.model_params)
+            return cross_validate(build_model, Xs[method], np.array(y), 3,
+                                  max_workers=self.tf_workers,
+                                  **self.fit_params)
+        return self._memoized(('validation', method), validate)
+
+
+CONTEXT = ExportContext(BlobCache())
+SWEEP_CHECKPOINTS_DIR = '.sweep_checkpoints'
+# Training options of last run, rewritten only when they change
+TRAINING_STAMP = '.thesis_stamps/training_options.json'
 
 
 def temp_bounds_imgs_gen():
@@ -30,10 +146,7 @@ def temp_bounds_imgs_gen():
     img = rgb2gray(img)
     img = invert(img)
 
-    bounds = (((6, 24), (283, 318)),
-              ((219, 236), (283, 318)))
-
-    for bound in bounds:
+    for bound in TEMPERATURE_BOUNDS:
         bound_img = img[slice(*bound[0]), slice(*bound[1])]
         bound_img = rescale(bound_img, 4, anti_aliasing=True)
         thr = threshold_otsu(bound_img)
@@ -52,96 +165,71 @@ def temp_bounds_imgs_gen():
 def grain_samples_imgs_gen():
     samples_names = ('104_E5R', '117_E6R')
     for name in samples_names:
-        imgs = load_img_series('img/' + name)
-        for i, img in enumerate(imgs):
-            img = rgb2gray(img)
+        for i, img in enumerate(CONTEXT.imgs_crop(name)):
             imsave('exports/' + name + '_' + str(i) + '.png',
-                   img_as_ubyte(crop_ui(img)))
+                   img_as_ubyte(img))
 
 
 def blob_detection_compare_plots_gen():
-    img = imread('img/104_E5R_0.jpg')
-    img_crop = crop_ui(rgb2gray(img))
-    img_prep = full_prepare(img)
+    import tikzplotlib
+    from blob_detection_compare_demo import compare_detection
+
+    img_crop = CONTEXT.imgs_crop('104_E5R')[0]
+    img_prep = CONTEXT.imgs_prep('104_E5R')[0]
     blobs_list = compare_detection(img_prep)
 
     suffixes = ('LoG', 'DoG', 'DoH')
 
     for blobs, suffix in zip(blobs_list, suffixes):
-        _, ax = plt.subplots()
+        fig, ax = plt.subplots()
         plt.title('Liczba wykrytych detali: {}'.format(len(blobs)))
         plt.imshow(img_crop, cmap=plt.get_cmap('gray'))
-        for blob in blobs:
-            y, x, r = blob
-            c = plt.Circle((x, y), r, color='r', fill=False)
-            ax.add_patch(c)
+        plot_blobs(ax, blobs, linewidth=None)
 
         ax.set_axis_off()
         tikzplotlib.save('exports/blob_detection_compare_' + suffix)
+        plt.close(fig)
 
 
 def blob_count_plots_gen():
-    imgs = load_img_series('img/104_E5R')
-    imgs_prep = [full_prepare(img) for img in imgs]
-    imgs_crop = [crop_ui(rgb2gray(img)) for img in imgs]
+    imgs_crop = CONTEXT.imgs_crop('104_E5R')
 
-    stages_all = find_blob_series(imgs_prep, only_remaining=False)
-    stages_rem = find_blob_series(imgs_prep)
+    stages_all = CONTEXT.blob_series('104_E5R')
+    stages_rem = track_remaining_blobs(stages_all)
 
     # Map stages on first image
     colors = ('blue', 'blueviolet', 'magenta', 'crimson', 'red')
-    fig = plt.figure(frameon=False)
-    ax = fig.add_axes([0, 0, 1, 1])
-    plt.imshow(imgs_crop[0], cmap=plt.get_cmap('gray'))
-    for stage, color in zip(stages_rem, colors):
-        for blob in stage:
-            y, x, r = blob
-            c = plt.Circle((x, y), r, color=color, fill=False)
-            ax.add_patch(c)
-    ax.set_axis_off()
-    plt.savefig('exports/blob_tracker', dpi=300)
+    overlay_figure = BlobOverlayFigure(dpi=300, linewidth=None)
+    overlay_figure.render(imgs_crop[0], stages_rem, colors,
+                          'exports/blob_tracker')
 
     # Show two methods combined to compare
     loop_set = enumerate(zip(stages_rem, stages_all, imgs_crop))
-    for i, (stage_rem, stage_all, img) in loop_set:
-        fig = plt.figure(frameon=False)
-        ax = fig.add_axes([0, 0, 1, 1])
-        plt.imshow(img, cmap=plt.get_cmap('gray'))
-        for blob_all in stage_all:
-            y, x, r = blob_all
-            c = plt.Circle((x, y), r, color='b', fill=False)
-            ax.add_patch(c)
-        for blob_rem in stage_rem:
-            y, x, r = blob_rem
-            c = plt.Circle((x, y), r, color='r', fill=False)
-            ax.add_patch(c)
-
-        ax.set_axis_off()
-        plt.savefig('exports/blob_tracker_min_' + str(i))
+    frames = ((img, (stage_all, stage_rem),
+               'exports/blob_tracker_min_' + str(i))
+              for i, (stage_rem, stage_all, img) in loop_set)
+    render_blob_overlays(frames, ('b', 'r'), max_workers=1, linewidth=None)
 
 
 def blob_ratio_table_gen():
     sample_names = ('104_E5R', '106_E11R', '107_E6R', '111_E16R')
 
-    with open('exports/neural_network_comparison.csv', 'w') as csvfile:
+    with open('exports/blob_ratio.csv', 'w') as csvfile:
         filewriter = csv.writer(csvfile, delimiter=';')
         # Header
         filewriter.writerow(('Próbka', 'Minuta 0', 'Minuta 1', 'Minuta 2',
                              'Minuta 3', 'Minuta 4'))
         for name in sample_names:
-            imgs = load_img_series('img/' + name)
-            imgs_prep = [full_prepare(img) for img in imgs]
-            stages_rem = find_blob_series(imgs_prep)
+            stages_rem = track_remaining_blobs(CONTEXT.blob_series(name))
             ratios = ratio_of_remaining_blobs_in_stages(stages_rem)
             ratios = (round(ratio, 2) for ratio in ratios)
             filewriter.writerow((name, *ratios))
 
 
 def blob_analysis_plots_gen():
-    X, y = default_img_set()
-    X = [[full_prepare(img) for img in same_sample] for same_sample in X]
+    import tikzplotlib
 
-    Xa, Xr, Xp = count_blobs_with_all_methods(X)
+    (Xa, Xr, Xp), y = CONTEXT.blob_counts()
 
     colors = ('r', 'g', 'b', 'y')
     labels = ('E5R', 'E11R', 'E6R', 'E16R')
@@ -169,9 +257,10 @@ def blob_analysis_plots_gen():
 
 
 def neural_network_trainig_plots_gen():
-    X, y = default_img_set()
-    X = [[full_prepare(img) for img in same_sample] for same_sample in X]
-    Xs = count_blobs_with_all_methods(X)
+    import tikzplotlib
+    from neural_network import fit_model, grain_classifier_model
+
+    Xs, y = CONTEXT.blob_counts()
 
     files_suffixes = ('all', 'remaining', 'ratio')
 
@@ -182,12 +271,8 @@ def neural_network_trainig_plots_gen():
         X_train, _, y_train, _ = train_test_split(
             X, y, stratify=y, test_size=0.33, random_state=1)
 
-        model = default_grain_classifier_model()
-        model.compile(
-            optimizer='adam',
-            loss='sparse_categorical_crossentropy',
-            metrics=['accuracy'])
-        history = model.fit(X_train, y_train, epochs=300, verbose=0)
+        model = grain_classifier_model(**CONTEXT.model_params)
+        history = fit_model(model, X_train, y_train, **CONTEXT.fit_params)
 
         plt.figure()
         plt.title('Historia treningu modelu')
@@ -202,9 +287,9 @@ def neural_network_trainig_plots_gen():
 
 
 def neural_network_test_table_gen():
-    X, y = default_img_set()
-    X = [[full_prepare(img) for img in same_sample] for same_sample in X]
-    Xs = count_blobs_with_all_methods(X)
+    from neural_network import fit_model, grain_classifier_model
+
+    Xs, y = CONTEXT.blob_counts()
     Xs = [np.array(X_count) for X_count in Xs]
     y = np.array(y)
 
@@ -223,24 +308,14 @@ def neural_network_test_table_gen():
             X_train, X_test, y_train, y_test = train_test_split(
                 X, y, stratify=y, test_size=0.33, random_state=1)
 
-            model = default_grain_classifier_model()
-            model.compile(
-                optimizer='adam',
-                loss='sparse_categorical_crossentropy',
-                metrics=['accuracy'])
-            model.fit(X_train, y_train, epochs=300, verbose=0)
+            model = grain_classifier_model(**CONTEXT.model_params)
+            fit_model(model, X_train, y_train, **CONTEXT.fit_params)
 
             score = model.evaluate(X_test, y_test, verbose=0)
             filewriter.writerow((name, *score))
 
 
 def neural_network_validation_table_gen():
-    X, y = default_img_set()
-    X = [[full_prepare(img) for img in same_sample] for same_sample in X]
-    Xs = count_blobs_with_all_methods(X)
-    Xs = [np.array(X_count) for X_count in Xs]
-    y = np.array(y)
-
     row_names = ('Wszystkie detale', 'Śledzone detale',
                  'Stosunek śledzonych detali')
 
@@ -251,127 +326,62 @@ def neural_network_validation_table_gen():
                      'wskaźnik'))
         filewriter.writerow(('Metoda zliczania detali', 'Błąd', 'Dokładność'))
 
-        for X, name in zip(Xs, row_names):
-            model = default_grain_classifier_model()
-            model.compile(
-                optimizer='adam',
-                loss='sparse_categorical_crossentropy',
-                metrics=['accuracy'])
-
-            scores = np.array(network_cross_validation(model, X, y, 3))
-            score = np.round(scores.mean(axis=0), 2)
+        for method, name in enumerate(row_names):
+            validation = CONTEXT.cross_validation(method)
+            score = np.round((validation.loss.mean(),
+                              validation.accuracy.mean()), 2)
             filewriter.writerow((name, *score))
 
 
 def network_comparison_table_gen():
-    X, y = default_img_set()
-    X = [[full_prepare(img) for img in same_sample] for same_sample in X]
-    X = [
-        ratio_of_remaining_blobs_in_stages(find_blob_series(img_series))
-        for img_series in X
-    ]
-    X = np.array(X)
+    from neural_network import sweep_cross_validation
+
+    Xs, y = CONTEXT.blob_counts()
+    X = Xs[2]
     y = np.array(y)
 
+    # Compared parameter, its value and grain_classifier_model config
+    rows = []
+    # Activation functions
+    activation_funcs = ('sigmoid', 'relu', 'elu', 'tanh')
+    for func in activation_funcs:
+        rows.append(('Funkcja aktywacji', func, {'activation': func}))
+    # Number of hidden layers
+    for hidden_layers in ((512,), (256, 128)):
+        rows.append(('Liczba warstw ukrytych', len(hidden_layers),
+                     {'hidden_layers': hidden_layers}))
+    # Number of neurons in hidden layers
+    neurons_num = ((128, 64), (256, 128), (512, 126))
+    for num in neurons_num:
+        rows.append(('Liczba neuronów w warstwach ukrytych',
+                     '{} i {}'.format(num[0], num[1]),
+                     {'hidden_layers': num}))
+    # Optimizer
+    optimizers = ('sgd', 'adam')
+    for opt in optimizers:
+        rows.append(('Algorytm uczenia', opt, {'optimizer': opt}))
+
+    validations = sweep_cross_validation(
+        [dict(CONTEXT.model_params, **config) for _, _, config in rows],
+        X, y, 3, **CONTEXT.fit_params,
+        checkpoint_path=os.path.join(SWEEP_CHECKPOINTS_DIR,
+                                     'network_comparison.jsonl'),
+        max_workers=CONTEXT.tf_workers)
+
     with open('exports/neural_network_comparison.csv', 'w') as csvfile:
         filewriter = csv.writer(csvfile, delimiter=';')
         # Header
         filewriter.writerow(('Parametr', 'Wartość', 'Błąd', 'Dokładność'))
 
-        # Activation functions
-        activation_funcs = ('sigmoid', 'relu', 'elu', 'tanh')
-        for func in activation_funcs:
-            model = keras.Sequential([
-                keras.layers.Dense(5, activation=func),
-                keras.layers.Dense(256, activation=func),
-                keras.layers.Dense(128, activation=func),
-                keras.layers.Dense(4, activation='softmax')
-            ])
-
-            model.compile(
-                optimizer='adam',
-                loss='sparse_categorical_crossentropy',
-                metrics=['accuracy'])
-            scores = np.array(network_cross_validation(model, X, y, 3))
-            score = np.round(scores.mean(axis=0), 2)
-
-            filewriter.writerow(('Funkcja aktywacji', func, *score))
-
-        # Number of hidden layers
-        models = []
-        models.append(
-            keras.Sequential([
-                keras.layers.Dense(5, activation='tanh'),
-                keras.layers.Dense(512, activation='tanh'),
-                keras.layers.Dense(4, activation='softmax')
-            ]))
-        models.append(
-            keras.Sequential([
-                keras.layers.Dense(5, activation='tanh'),
-                keras.layers.Dense(256, activation='tanh'),
-                keras.layers.Dense(128, activation='tanh'),
-                keras.layers.Dense(4, activation='softmax')
-            ]))
-
-        for model, i in zip(models, (1, 2)):
-            model.compile(
-                optimizer='adam',
-                loss='sparse_categorical_crossentropy',
-                metrics=['accuracy'])
-            scores = np.array(network_cross_validation(model, X, y, 3))
-            score = np.round(scores.mean(axis=0), 2)
-
-            filewriter.writerow(('Liczba warstw ukrytych', i, *score))
-
-        # Number of neurons in hidden layers
-        neurons_num = ((128, 64), (256, 128), (512, 126))
-
-        for num in neurons_num:
-            model = keras.Sequential([
-                keras.layers.Dense(5, activation='tanh'),
-                keras.layers.Dense(num[0], activation='tanh'),
-                keras.layers.Dense(num[1], activation='tanh'),
-                keras.layers.Dense(4, activation='softmax')
-            ])
-
-            model.compile(
-                optimizer='adam',
-                loss='sparse_categorical_crossentropy',
-                metrics=['accuracy'])
-            scores = np.array(network_cross_validation(model, X, y, 3))
-            score = np.round(scores.mean(axis=0), 2)
-
-            filewriter.writerow(('Liczba neuronów w warstwach ukrytych',
-                                 '{} i {}'.format(num[0], num[1]), *score))
-
-        # Optimizer
-        model = default_grain_classifier_model()
-        optimizers = ('sgd', 'adam')
-        for opt in optimizers:
-            model.compile(
-                optimizer=opt,
-                loss='sparse_categorical_crossentropy',
-                metrics=['accuracy'])
-            scores = np.array(network_cross_validation(model, X, y, 3))
-            score = np.round(scores.mean(axis=0), 2)
-
-            filewriter.writerow(('Algorytm uczenia', opt, *score))
+        for (param, value, _), validation in zip(rows, validations):
+            score = np.round((validation.loss.mean(),
+                              validation.accuracy.mean()), 2)
+            filewriter.writerow((param, value, *score))
 
 
 def confusion_matrix_table_gen():
-    X, y = default_img_set()
-    X = [[full_prepare(img) for img in same_sample] for same_sample in X]
-    X = count_blobs_with_all_methods(X)[2]
-    X = np.array(X)
-    y = np.array(y)
-
-    model = default_grain_classifier_model()
-    model.compile(
-        optimizer='adam',
-        loss='sparse_categorical_crossentropy',
-        metrics=['accuracy'])
-
-    mcm = mean_confusion_matrix(model, X, y, 3)
+    # Reuses folds trained for ratio row of validation table
+    mcm = CONTEXT.cross_validation(2).conf_matrix
     np.savetxt(
         "exports/mean_confusion_matrix_ratio.csv",
         mcm,
@@ -385,22 +395,262 @@ def clear_dir(dir_to_clear):
             os.remove(os.path.join(root, file_to_rm))
 
 
-if __name__ == '__main__':
-    if not os.path.exists('exports'):
-        os.makedirs('exports')
+# Generator of stage, glob patterns of files it writes and reads, stages
+# whose results kept in CONTEXT it reuses and whether it uses blob counts
+# of default set
+Stage = namedtuple('Stage', ['gen', 'outputs', 'inputs', 'deps',
+                             'uses_counts'], defaults=(False,))
+
+DETECTION_INPUTS = ('thesis_generator.py', 'img_processing.py',
+                    'blob_finder.py', 'blob_series_tracker.py')
+PLOTTING_INPUTS = DETECTION_INPUTS + ('plotting.py',)
+NETWORK_INPUTS = DETECTION_INPUTS + ('neural_network.py', 'img/*.jpg',
+                                     TRAINING_STAMP)
+
+STAGES = OrderedDict((
+    ('temp_bounds_imgs', Stage(
+        temp_bounds_imgs_gen,
+        ('exports/temp_bounds_scale.png', 'exports/temp_bounds_bin.png'),
+        DETECTION_INPUTS + ('img/103_E5R_1.jpg',), ())),
+    ('grain_samples_imgs', Stage(
+        grain_samples_imgs_gen,
+        ('exports/104_E5R_*.png', 'exports/117_E6R_*.png'),
+        DETECTION_INPUTS + ('img/104_E5R_*.jpg', 'img/117_E6R_*.jpg'), ())),
+    ('blob_detection_compare_plots', Stage(
+        blob_detection_compare_plots_gen,
+        ('exports/blob_detection_compare_*',),
+        PLOTTING_INPUTS + ('img/104_E5R_0.jpg',), ())),
+    ('blob_ratio_table', Stage(
+        blob_ratio_table_gen,
+        ('exports/blob_ratio.csv',),
+        DETECTION_INPUTS + ('img/*.jpg',), ())),
+    ('blob_count_plots', Stage(
+        blob_count_plots_gen,
+        ('exports/blob_tracker.png', 'exports/blob_tracker_min_*.png'),
+        PLOTTING_INPUTS + ('img/104_E5R_*.jpg',), ())),
+    ('blob_analysis_plots', Stage(
+        blob_analysis_plots_gen,
+        ('exports/blob_analysis_*',),
+        PLOTTING_INPUTS + ('img/*.jpg',), (), True)),
+    ('neural_network_test_table', Stage(
+        neural_network_test_table_gen,
+        ('exports/neural_network_test.csv',), NETWORK_INPUTS, (), True)),
+    ('neural_network_validation_table', Stage(
+        neural_network_validation_table_gen,
+        ('exports/neural_network_validation.csv',), NETWORK_INPUTS, (), True)),
+    ('neural_network_trainig_plots', Stage(
+        neural_network_trainig_plots_gen,
+        ('exports/neural_network_trainig_*',), NETWORK_INPUTS, (), True)),
+    ('network_comparison_table', Stage(
+        network_comparison_table_gen,
+        ('exports/neural_network_comparison.csv',), NETWORK_INPUTS, (), True)),
+    ('confusion_matrix_table', Stage(
+        confusion_matrix_table_gen,
+        ('exports/mean_confusion_matrix_ratio.csv',), NETWORK_INPUTS,
+        ('neural_network_validation_table',), True)),
+))
+
+
+def is_stage_outdated(stage):
+    '''
+    Check if any of stage outputs is missing or older than newest of its
+    inputs, the same way make does.
+    '''
+    outputs = [glob.glob(pattern) for pattern in stage.outputs]
+    if not all(outputs):
+        return True
+    oldest_output = min(os.path.getmtime(path)
+                        for paths in outputs for path in paths)
+    newest_input = max((os.path.getmtime(path)
+                        for pattern in stage.inputs
+                        for path in glob.glob(pattern)), default=0)
+    return newest_input > oldest_output
+
+
+def stage_chains(names):
+    '''
+    Group stages with given names into chains of stages connected through
+    their dependencies. Each chain is run in one process in STAGES order,
+    so that its stages reuse results computed in CONTEXT, while separate
+    chains are independent.
+    '''
+    # Union stages with their dependencies into groups
+    group_of = {name: name for name in names}
+
+    def find(name):
+        while group_of[name] != name:
+            name = group_of[name]
+        return name
+
+    for name in names:
+        for dep in STAGES[name].deps:
+            if dep in group_of:
+                group_of[find(name)] = find(dep)
+
+    chains = OrderedDict()
+    for name in STAGES:
+        if name in group_of:
+            chains.setdefault(find(name), []).append(name)
+    return list(chains.values())
+
+
+def _init_stage_worker(model_params, fit_params, tf_workers, context_values):
+    CONTEXT.model_params = model_params
+    CONTEXT.fit_params = fit_params
+    CONTEXT.tf_workers = tf_workers
+    CONTEXT.update(context_values)
+
+
+def run_stage_chain(names):
+    '''
+    Run stages one after another and get name, running time and error,
+    if stage failed, of each of them.
+    '''
+    results = []
+    for name in names:
+        start = time.perf_counter()
+        try:
+            STAGES[name].gen()
+            error = None
+        except Exception as exc:
+            error = '{}: {}'.format(type(exc).__name__, exc)
+        finally:
+            # Figures are only saved, free them before next stage
+            plt.close('all')
+        results.append((name, time.perf_counter() - start, error))
+    return results
+
+
+def _report_stages(results):
+    '''Print results of stages run in chain and get names of failed ones.'''
+    failed = []
+    for name, duration, error in results:
+        if error is None:
+            print('{}: {:.1f} s'.format(name, duration))
+        else:
+            print('{}: failed after {:.1f} s, {}'.format(name, duration,
+                                                        error))
+            failed.append(name)
+    return failed
+
+
+def update_training_stamp(path=TRAINING_STAMP):
+    '''
+    Write model and fit parameters of CONTEXT to stamp file if they differ
+    from ones stored there, so that stages training networks are outdated
+    whenever training options change.
+    '''
+    options = {'model_params': CONTEXT.model_params,
+               'fit_params': CONTEXT.fit_params}
+    try:
+        with open(path) as stamp:
+            if json.load(stamp) == options:
+                return
+    except (OSError, ValueError):
+        pass
+    stamp_dir = os.path.dirname(path)
+    if stamp_dir:
+        os.makedirs(stamp_dir, exist_ok=True)
+    with open(path, 'w') as stamp:
+        json.dump(options, stamp, sort_keys=True)
+
+
+def run_stages(names=None, force=False, max_workers=None):
+    '''
+    Run stages with given names, or all, skipping ones whose outputs are up
+    to date unless forced. Independent stage chains run in parallel in up to
+    max_workers processes, blob counts they share are computed beforehand
+    in current process. Cores are split evenly between concurrent chains
+    for their TensorFlow training processes. Get names of stages that failed.
+    '''
+    if names is None:
+        names = list(STAGES)
+    update_training_stamp()
+    outdated = [name for name in names
+                if force or is_stage_outdated(STAGES[name])]
+    for name in names:
+        if name not in outdated:
+            print('{}: up to date'.format(name))
+    if not outdated:
+        return []
+
+    os.makedirs('exports', exist_ok=True)
+    chains = stage_chains(outdated)
+    if max_workers is None:
+        max_workers = min(len(chains), os.cpu_count())
+    failed = []
+    if max_workers == 1:
+        for chain in chains:
+            failed += _report_stages(run_stage_chain(chain))
     else:
-        clear_dir('exports')
-
-    temp_bounds_imgs_gen()
-    grain_samples_imgs_gen()
-    blob_detection_compare_plots_gen()
-    blob_ratio_table_gen()
-    blob_count_plots_gen()
-    blob_analysis_plots_gen()
-    neural_network_test_table_gen()
-    neural_network_validation_table_gen()
-    neural_network_trainig_plots_gen()
-    network_comparison_table_gen()
-    confusion_matrix_table_gen()
-
-    plt.show()
+        # Detect blobs once for all chains, instead of each chain decoding
+        # default set in its own pool of processes
+        if any(STAGES[name].uses_counts for name in outdated):
+            CONTEXT.blob_counts()
+        # Chains training networks at once would otherwise each start
+        # a process per core
+        tf_workers = max(1, os.cpu_count() // min(len(chains), max_workers))
+        with ProcessPoolExecutor(max_workers=max_workers,
+                                 initializer=_init_stage_worker,
+                                 initargs=(CONTEXT.model_params,
+                                           CONTEXT.fit_params, tf_workers,
+                                           CONTEXT.values())) as executor:
+            futures = [executor.submit(run_stage_chain, chain)
+                       for chain in chains]
+            for future in as_completed(futures):
+                failed += _report_stages(future.result())
+    return failed
+
+
+def main():
+    '''Generate selected or all outdated exports for thesis.'''
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument('stages', nargs='*', metavar='stage',
+                        help='stages to run, all by default: ' +
+                        ', '.join(STAGES))
+    parser.add_argument('-f', '--force', action='store_true',
+                        help='run stages even if their outputs are up to date')
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+                        help='number of parallel processes')
+    parser.add_argument('--clean', action='store_true',
+                        help='remove all exports and checkpoints of '
+                        'cross validation sweeps before running')
+    parser.add_argument('--epochs', type=int, default=None,
+                        help='maximum number of training epochs, 300 by '
+                        'default')
+    parser.add_argument('--patience', type=int, default=None,
+                        help='stop training once validation loss has not '
+                        'improved for given number of epochs')
+    parser.add_argument('--full-batch', action='store_true',
+                        help='train on whole training set as single batch')
+    parser.add_argument('--float32', action='store_true',
+                        help='train classifiers in float32 instead of float64')
+    args = parser.parse_args()
+
+    unknown = [name for name in args.stages if name not in STAGES]
+    if unknown:
+        parser.error('unknown stages: ' + ', '.join(unknown))
+
+    # Only options differing from defaults are set, so that default run
+    # keeps the same training stamp
+    if args.float32:
+        CONTEXT.model_params['dtype'] = 'float32'
+    if args.epochs is not None:
+        CONTEXT.fit_params['epochs'] = args.epochs
+    if args.patience is not None:
+        CONTEXT.fit_params['patience'] = args.patience
+    if args.full_batch:
+        CONTEXT.fit_params['full_batch'] = True
+
+    use_headless()
+    if args.clean:
+        for dir_to_clear in ('exports', SWEEP_CHECKPOINTS_DIR):
+            if os.path.exists(dir_to_clear):
+                clear_dir(dir_to_clear)
+    failed = run_stages(args.stages or None, args.force, args.jobs)
+    if failed:
+        sys.exit('Failed stages: ' + ', '.join(failed))
+
+
+if __name__ == '__main__':
+    main()